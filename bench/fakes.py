@@ -0,0 +1,168 @@
+# bench/fakes.py
+
+import asyncio
+import functools
+import json
+import random
+import time
+from datetime import date, timedelta
+
+from aiohttp import web
+
+from bot import mesh
+
+SUBJECTS = ["Математика", "Русский язык", "Литература", "История", "Физика",
+            "Химия", "Биология", "Английский язык", "Информатика", "География"]
+LESSONS_PER_DAY = 6
+
+
+@functools.lru_cache(maxsize=64)
+def events_json(begin: str, end: str) -> str:
+    """
+    Ответ get_events (сырой JSON, как от МЭШ) за [begin, end]: LESSONS_PER_DAY
+    уроков каждый день, у половины — домашнее задание. Ответ одинаков для всех
+    пользователей (id уроков уникальны в пределах даты), поэтому кэшируется.
+    """
+    first, last = date.fromisoformat(begin), date.fromisoformat(end)
+    items = []
+    for i in range((last - first).days + 1):
+        day = first + timedelta(days=i)
+        for k in range(LESSONS_PER_DAY):
+            minutes = 8 * 60 + 30 + k * 55
+            start = f"{day}T{minutes // 60:02}:{minutes % 60:02}:00+03:00"
+            minutes += 45
+            finish = f"{day}T{minutes // 60:02}:{minutes % 60:02}:00+03:00"
+            item = {
+                'id': day.toordinal() * 10 + k,
+                'source': 'PLAN',
+                'start_at': start,
+                'finish_at': finish,
+                'subject_name': SUBJECTS[(day.toordinal() + k) % len(SUBJECTS)],
+                'room_number': str(100 + k),
+                'lesson_theme': f"Тема {k + 1}",
+            }
+            if k % 2 == 0:
+                item['homework'] = {'descriptions': [f"Упражнение {day.day * 10 + k}", "Повторить параграф"]}
+            items.append(item)
+    return json.dumps({'total_count': len(items), 'response': items, 'errors': None}, ensure_ascii=False)
+
+
+class StubMobileAPI(mesh.PooledMobileAPI):
+    """
+    Заглушка клиента МЭШ: вместо HTTP — задержка latency ± jitter (доля)
+    и готовый ответ events_json(). Разбор ответа — как в PooledMobileAPI
+    (модель octodiary или сырой JSON для raw_models).
+    Поддерживается только get_events: идентичность пользователей
+    бенчмарк заранее кладёт в user_identity.
+    """
+
+    latency = 0.05
+    jitter = 0.5
+    calls = 0
+
+    async def request(self, method: str, base_url: str, path: str, custom_headers=None,
+                      model=None, is_list: bool = False, **kwargs):
+        StubMobileAPI.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if not path.endswith('/events'):
+            raise NotImplementedError(f"Заглушка МЭШ не поддерживает {path}")
+        params = kwargs.get('params', {})
+        raw_text = events_json(params['begin_date'], params['end_date'])
+        if model in self.raw_models:
+            return raw_text
+        return model.model_validate_json(raw_text)
+
+
+def install_mesh_stub(latency: float, jitter: float):
+    """
+    Подменяет клиент МЭШ заглушкой: create_api() создаёт StubMobileAPI.
+    """
+    StubMobileAPI.latency = latency
+    StubMobileAPI.jitter = jitter
+    StubMobileAPI.calls = 0
+    mesh.PooledMobileAPI = StubMobileAPI
+
+
+class FakeTelegram:
+    """
+    Локальный сервер Bot API: отвечает на методы, которые вызывает бот,
+    правдоподобными результатами после задержки latency. Считает вызовы по методам.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.base_url = None
+        self._runner = None
+        self._message_id = 0
+
+    async def start(self, port: int = 0) -> str:
+        """
+        Запускает сервер на 127.0.0.1:port (0 — любой свободный) и возвращает base_url для Bot.
+        """
+        app = web.Application(client_max_size=20 * 1024 ** 2)
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}/bot"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({'ok': True, 'result': self._result(method, data)})
+
+    def _result(self, method: str, data):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                    'can_join_groups': False, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method.startswith('send') or method.startswith('edit'):
+            self._message_id += 1
+            chat_id = int(data.get('chat_id') or 0)
+            message = {'message_id': self._message_id, 'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'}}
+            if 'Photo' in method or 'Media' in method or 'Caption' in method:
+                message['photo'] = [{'file_id': 'bench-photo', 'file_unique_id': 'bench-photo',
+                                     'width': 640, 'height': 480}]
+            if 'caption' in data:
+                message['caption'] = data['caption']
+            if 'text' in data:
+                message['text'] = data['text']
+            return message
+        return True
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    """
+    Апдейт нажатия инлайн-кнопки под фото-сообщением бота (сырой JSON Bot API).
+    """
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'photo': [{'file_id': 'calendar', 'file_unique_id': 'calendar', 'width': 640, 'height': 480}],
+                'caption': 'Выберите дату',
+            },
+        },
+    }
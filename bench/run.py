@@ -0,0 +1,416 @@
+# bench/run.py
+"""
+Бенчмарк горячих путей бота на синтетической популяции пользователей.
+
+МЭШ подменяется заглушкой (bench/fakes.py: StubMobileAPI с настраиваемой
+задержкой), Telegram — локальным сервером Bot API (FakeTelegram).
+Бот работает на отдельной временной БД и ключе шифрования: бенчмарк
+пишет свой config/settings.py во временный каталог и ставит его первым
+в sys.path, так что настоящие config/settings.py и база не используются.
+
+Запуск из корня репозитория:
+
+    python -m bench --users 10000 --mesh-latency 0.05
+
+Сценарии (по умолчанию — все, по порядку):
+  keyboard      — generate_calendar_keyboard
+  breaker       — переходы предохранителя МЭШ (проверки, errors — сколько
+                  не прошло) и цена allow()/record() в закрытом состоянии
+  store         — store_user_schedule (ответ МЭШ за окно обновления: хэши
+                  дней, отрисовка, удаление старых дней — как при обновлении)
+  day_cold      — process_calendar_day без локальных данных (идёт в МЭШ)
+  refresh       — полный проход refresh_all_schedules
+  refresh_same  — повторный проход, когда содержимое не изменилось
+  day_warm      — process_calendar_day из локальной БД
+  lesson        — lesson_detail
+
+Для каждого сценария — число операций, пропускная способность,
+p50/p99 задержки и пиковый RSS основного процесса; в конце — пиковый
+RSS процессов пула.
+Результат дописывается в bench_output.txt.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from datetime import date
+
+SCENARIOS = ('keyboard', 'breaker', 'store', 'day_cold', 'refresh', 'refresh_same', 'day_warm', 'lesson')
+
+SETTINGS_TEMPLATE = '''\
+TELEGRAM_TOKEN = "123456:BENCH"
+DATABASE_PATH = {database_path!r}
+ENCRYPTION_KEY_PATH = {key_path!r}
+TELEGRAM_API_URL = {api_url!r}
+REFRESH_POOL_SIZE = {pool}
+CONCURRENT_UPDATES = {concurrency}
+'''
+
+
+def write_settings(workdir: str, api_url: str, args):
+    """
+    Создаёт в workdir пакет config с настройками бенчмарка и ставит
+    workdir первым в sys.path (процессы пула, запущенные через spawn,
+    получают тот же sys.path).
+    """
+    package = os.path.join(workdir, 'config')
+    os.makedirs(package, exist_ok=True)
+    open(os.path.join(package, '__init__.py'), 'w').close()
+    with open(os.path.join(package, 'settings.py'), 'w') as f:
+        f.write(SETTINGS_TEMPLATE.format(
+            database_path=os.path.join(workdir, 'bench.db'),
+            key_path=os.path.join(workdir, 'encryption.key'),
+            api_url=api_url,
+            pool=args.pool,
+            concurrency=args.concurrency,
+        ))
+    sys.path.insert(0, workdir)
+    for name in ('config', 'config.settings'):
+        sys.modules.pop(name, None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    """
+    Пиковый RSS (МБ) этого процесса или (RUSAGE_CHILDREN) самого большого
+    из завершённых дочерних — процессы пула учитываются после shutdown_pool().
+    """
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+class Result:
+    """
+    Итог одного сценария.
+    """
+
+    def __init__(self, name: str, latencies, elapsed: float, errors: int = 0, note: str = ''):
+        self.name = name
+        self.latencies = latencies
+        self.elapsed = elapsed
+        self.errors = errors
+        self.note = note
+        self.rss = peak_rss_mb()
+
+    def line(self) -> str:
+        count = len(self.latencies)
+        throughput = count / self.elapsed if self.elapsed > 0 else 0.0
+        line = (
+            f"{self.name:<13} ops={count:<8} errors={self.errors:<5} "
+            f"throughput={throughput:>10.1f}/s "
+            f"p50={percentile(self.latencies, 0.50) * 1000:>8.2f}ms "
+            f"p99={percentile(self.latencies, 0.99) * 1000:>8.2f}ms "
+            f"peak_rss={self.rss:.0f}MB"
+        )
+        return f"{line} {self.note}".rstrip()
+
+
+def seed_population(users: int):
+    """
+    Пользователи 1..users: зашифрованный токен, идентичность в МЭШ
+    (get_events обходится без запросов профиля).
+    """
+    from bot.auth import encrypt_token
+    from bot.database import get_db_connection
+
+    now = time.time()
+    conn = get_db_connection()
+    with conn:
+        conn.executemany(
+            'REPLACE INTO users (telegram_user_id, encrypted_token) VALUES (?, ?)',
+            ((uid, encrypt_token(f"bench-token-{uid}")) for uid in range(1, users + 1))
+        )
+        conn.executemany(
+            'REPLACE INTO user_identity (telegram_user_id, profile_id, person_guid, mes_role, updated_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((uid, uid, f"guid-{uid}", 'student', now) for uid in range(1, users + 1))
+        )
+
+
+def bench_keyboard(iterations: int) -> Result:
+    from bot.utils import generate_calendar_keyboard
+
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        generate_calendar_keyboard(i % 21)
+        latencies.append(time.perf_counter() - t)
+    return Result('keyboard', latencies, time.perf_counter() - started)
+
+
+def check_breaker():
+    """
+    Проверяет переходы CircuitBreaker на своём экземпляре (mesh.breaker не трогается).
+    Возвращает имена непройденных проверок.
+    """
+    from bot.mesh import CircuitBreaker
+
+    failed = []
+
+    def check(name, ok):
+        if not ok:
+            failed.append(name)
+
+    b = CircuitBreaker(failures=3, slow_call=1.0, cooldown=0.05, max_cooldown=1.0)
+    stale = b.allow()  # отправлен до открытия, ответит позже
+    admitted = [b.allow() for _ in range(3)]
+    b.record(admitted[0], False)
+    b.record(admitted[1], True, 5.0)  # слишком медленный ответ — тоже отказ
+    check('closed_below_threshold', b.state == b.CLOSED)
+    b.record(admitted[2], False)
+    check('open_after_threshold', b.state == b.OPEN and not b.allow())
+    b.record(stale, True, 0.01)
+    check('stale_success_ignored_when_open', b.state == b.OPEN)
+
+    time.sleep(b.cooldown)
+    probe = b.allow()
+    check('single_half_open_probe', probe == b.HALF_OPEN and not b.allow())
+    b.release(stale)
+    check('stale_release_keeps_probe', not b.allow())
+    b.record(stale, False)
+    check('stale_failure_ignored_when_half_open', b.state == b.HALF_OPEN)
+    b.record(probe, False)
+    check('failed_probe_reopens_with_longer_cooldown', b.state == b.OPEN and b.cooldown == 0.1)
+
+    time.sleep(b.cooldown)
+    b.release(b.allow())
+    probe = b.allow()
+    check('cancelled_probe_can_be_resent', probe == b.HALF_OPEN)
+    b.record(probe, True, 0.01)
+    check('probe_success_closes', b.state == b.CLOSED and b.failures == 0 and b.cooldown == 0.05)
+    return failed
+
+
+def bench_breaker(iterations: int) -> Result:
+    from bot.mesh import CircuitBreaker
+
+    failed = check_breaker()
+    b = CircuitBreaker(failures=5, slow_call=10.0, cooldown=30.0, max_cooldown=600.0)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        b.record(b.allow(), True, 0.01)
+        latencies.append(time.perf_counter() - t)
+    return Result('breaker', latencies, time.perf_counter() - started, errors=len(failed),
+                  note=f"(failed: {', '.join(failed)})" if failed else '(transitions ok)')
+
+
+def bench_store(sample) -> Result:
+    from octodiary.types.mobile import EventsResponse
+    from bot.database import store_user_schedule
+    from bot.refresher import refresh_window, purge_date
+    from .fakes import events_json
+
+    begin_date, end_date = refresh_window()
+    purge_before = purge_date()
+    events = EventsResponse.model_validate_json(events_json(str(begin_date), str(end_date)))
+    latencies = []
+    changed_days = 0
+    started = time.perf_counter()
+    for uid in sample:
+        t = time.perf_counter()
+        changed_days += store_user_schedule(uid, events, begin_date, end_date, purge_before)
+        latencies.append(time.perf_counter() - t)
+    return Result('store', latencies, time.perf_counter() - started,
+                  note=f"(lessons/call={len(events.response)} changed_days={changed_days})")
+
+
+async def bench_updates(name: str, application, updates, concurrency: int, errors: list) -> Result:
+    """
+    Прогоняет апдейты через application.process_update (все хендлеры,
+    включая CallbackRouter и track_activity), не больше concurrency одновременно.
+    """
+    from telegram import Update
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors_before = len(errors)
+
+    async def one(data):
+        update = Update.de_json(data, application.bot)
+        async with semaphore:
+            t = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - t)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(data) for data in updates))
+    return Result(name, latencies, time.perf_counter() - started, errors=len(errors) - errors_before)
+
+
+async def bench_refresh(name: str, args) -> Result:
+    from bot.refresher import refresh_all_schedules
+
+    stats = await refresh_all_schedules(concurrency=args.refresh_concurrency, rate=args.rate,
+                                        timeout=max(30, args.mesh_latency * 20))
+    return Result(name, stats.latencies, stats.elapsed, errors=stats.failed + stats.write_failed,
+                  note=f"(ok={stats.ok} fresh={stats.fresh} changed_days={stats.changed_days} "
+                       f"commits={stats.commits})")
+
+
+async def run(args, workdir: str):
+    # Настройки пишутся до первого импорта бота: модули читают их при импорте
+    port = free_port()
+    write_settings(workdir, f"http://127.0.0.1:{port}/bot", args)
+
+    import main
+    from bot.database import init_db, init_schedule_db, init_media_db, init_persistence_db, get_db_connection
+    from bot.mesh import close_http_session
+    from bot.offload import shutdown_pool
+    from bot.utils import compute_21days
+    from .fakes import FakeTelegram, StubMobileAPI, install_mesh_stub, callback_update
+
+    telegram = FakeTelegram(args.telegram_latency)
+    await telegram.start(port)
+    install_mesh_stub(args.mesh_latency, args.mesh_jitter)
+    init_db()
+    init_schedule_db()
+    init_media_db()
+    init_persistence_db()
+
+    started = time.perf_counter()
+    seed_population(args.users)
+    header = (
+        f"# bench {time.strftime('%Y-%m-%d %H:%M:%S')} users={args.users} sample={args.sample} "
+        f"mesh_latency={args.mesh_latency}s±{args.mesh_jitter:.0%} telegram_latency={args.telegram_latency}s "
+        f"concurrency={args.concurrency} refresh_concurrency={args.refresh_concurrency} "
+        f"pool={args.pool} (seed {time.perf_counter() - started:.1f}s)"
+    )
+    print(header, flush=True)
+    lines = [header]
+
+    def report(result: Result):
+        print(result.line(), flush=True)
+        lines.append(result.line())
+
+    rng = random.Random(args.seed)
+    sample = rng.sample(range(1, args.users + 1), min(args.sample, args.users))
+    today = compute_21days().index(date.today())
+
+    application = main.build_application()
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(context.error)
+        if len(errors) <= 3:
+            logging.getLogger('bench').error("Ошибка в хендлере: %r", context.error)
+
+    application.add_error_handler(on_error)
+    await application.initialize()
+    update_id = 0
+
+    def updates(data_for):
+        nonlocal update_id
+        batch = []
+        for uid in sample:
+            update_id += 1
+            batch.append(callback_update(update_id, uid, data_for(uid)))
+        return batch
+
+    try:
+        for scenario in args.scenarios:
+            if scenario == 'keyboard':
+                report(bench_keyboard(len(sample) * 10))
+            elif scenario == 'breaker':
+                report(bench_breaker(len(sample) * 10))
+            elif scenario == 'store':
+                report(bench_store(sample))
+                # следующим сценариям нужен «чистый» пользователь без локальных данных
+                with get_db_connection() as conn:
+                    conn.execute('DELETE FROM schedule')
+                    conn.execute('DELETE FROM schedule_days')
+            elif scenario in ('day_cold', 'day_warm'):
+                with get_db_connection() as conn:
+                    if scenario == 'day_cold':
+                        conn.execute('DELETE FROM schedule')
+                        conn.execute('DELETE FROM schedule_days')
+                calls = StubMobileAPI.calls
+                result = await bench_updates(scenario, application, updates(lambda uid: f"cal21_day_{today}"),
+                                             args.concurrency, errors)
+                result.note = f"(mesh_calls={StubMobileAPI.calls - calls})"
+                report(result)
+            elif scenario == 'lesson':
+                report(await bench_updates(scenario, application, updates(lambda uid: "lesson_0"),
+                                           args.concurrency, errors))
+            elif scenario == 'refresh':
+                with get_db_connection() as conn:
+                    conn.execute('DELETE FROM schedule')
+                    conn.execute('DELETE FROM schedule_days')
+                report(await bench_refresh(scenario, args))
+            elif scenario == 'refresh_same':
+                # все дни «устарели», но МЭШ отдаёт то же самое — запись только отметок свежести
+                with get_db_connection() as conn:
+                    conn.execute('UPDATE schedule_days SET fetched_at = 0')
+                report(await bench_refresh(scenario, args))
+    finally:
+        await application.shutdown()
+        await close_http_session()
+        shutdown_pool()
+        await telegram.stop()
+
+    calls = ' '.join(f"{method}={n}" for method, n in sorted(telegram.calls.items()))
+    lines.append(f"# telegram: {calls}; mesh calls: {StubMobileAPI.calls}")
+    lines.append(f"# peak rss: main={peak_rss_mb():.0f}MB, "
+                 f"pool process={peak_rss_mb(resource.RUSAGE_CHILDREN):.0f}MB")
+    print('\n'.join(lines[-2:]))
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=1000, help="размер популяции (1k–100k)")
+    parser.add_argument('--sample', type=int, default=1000,
+                        help="сколько пользователей нажимают кнопки в интерактивных сценариях")
+    parser.add_argument('--mesh-latency', type=float, default=0.05, help="задержка МЭШ, секунды")
+    parser.add_argument('--mesh-jitter', type=float, default=0.5, help="разброс задержки МЭШ, доля")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="задержка Bot API, секунды")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="одновременных апдейтов (как CONCURRENT_UPDATES)")
+    parser.add_argument('--refresh-concurrency', type=int, default=100,
+                        help="одновременных пользователей в проходе обновления")
+    parser.add_argument('--rate', type=float, default=1e6, help="лимит запросов к МЭШ в секунду")
+    parser.add_argument('--pool', type=int, default=0, help="REFRESH_POOL_SIZE (0 — без пула процессов)")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help="каталог для БД бенчмарка (по умолчанию временный, удаляется)")
+    parser.add_argument('--output', default='bench_output.txt')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+    workdir = args.workdir or tempfile.mkdtemp(prefix='meshbot-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        asyncio.run(run(args, workdir))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
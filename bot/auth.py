@@ -1,16 +1,29 @@
 # bot/auth.py
 
 import os
+import base64
 import json
 import logging
+import time
 from cryptography.fernet import Fernet
-from octodiary.apis import AsyncMobileAPI
-from octodiary.urls import Systems
-from .database import get_db_connection
+from .database import (
+    get_db_connection,
+    run_db,
+    load_token_state,
+    save_token_state,
+    mark_token_used,
+)
+from .mesh import create_api, call_mesh, is_auth_error, MeshUnavailableError
+from .cache import token_cache
+from config import settings
 from config.settings import ENCRYPTION_KEY_PATH
 
 logger = logging.getLogger(__name__)
 
+# Сколько секунд после последнего успешного запроса к МЭШ
+# считаем токен рабочим без повторной проверки
+TOKEN_CHECK_TTL = getattr(settings, 'TOKEN_CHECK_TTL', 6 * 3600)
+
 def get_cipher_suite():
     if os.path.exists(ENCRYPTION_KEY_PATH):
         with open(ENCRYPTION_KEY_PATH, 'rb') as f:
@@ -33,13 +46,13 @@ def decrypt_token(encrypted_token):
 
 def save_token_db(telegram_user_id, encrypted_token):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        REPLACE INTO users (telegram_user_id, encrypted_token)
-        VALUES (?, ?)
-    ''', (telegram_user_id, encrypted_token))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            REPLACE INTO users (telegram_user_id, encrypted_token)
+            VALUES (?, ?)
+        ''', (telegram_user_id, encrypted_token))
+    token_cache.invalidate(telegram_user_id)
 
 def load_token_db(telegram_user_id):
     conn = get_db_connection()
@@ -48,27 +61,86 @@ def load_token_db(telegram_user_id):
         SELECT encrypted_token FROM users WHERE telegram_user_id = ?
     ''', (telegram_user_id,))
     row = cursor.fetchone()
-    conn.close()
     if row:
         return row[0]
     return None
 
-async def is_user_logged_in(telegram_user_id):
+def load_token(telegram_user_id):
+    """
+    Возвращает расшифрованный токен пользователя или None, если токена нет.
+    Сначала смотрит в token_cache (LRU с TTL), при промахе читает users
+    и расшифровывает. Ошибка расшифровки пробрасывается.
+    """
+    token_data = token_cache.get(telegram_user_id)
+    if token_data is None:
+        encrypted_token = load_token_db(telegram_user_id)
+        if not encrypted_token:
+            return None
+        token_data = decrypt_token(encrypted_token)
+        token_cache.put(telegram_user_id, token_data)
+    return token_data
+
+def decrypt_token_cached(telegram_user_id, encrypted_token):
+    """
+    Как decrypt_token, но через token_cache — когда зашифрованный токен
+    уже прочитан из БД (например, при фоновом обновлении всех пользователей).
+    """
+    token_data = token_cache.get(telegram_user_id)
+    if token_data is None:
+        token_data = decrypt_token(encrypted_token)
+        token_cache.put(telegram_user_id, token_data)
+    return token_data
+
+def token_expiry(token):
+    """
+    Возвращает срок действия токена (unix time) из поля exp JWT
+    или None, если токен не JWT или exp в нём нет.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+async def is_user_logged_in(telegram_user_id, verify=False):
     """
     Проверяет, есть ли у пользователя валидный токен.
-    Если да, пытается вызвать get_users_profile_info().
+    Сначала по локальному состоянию (token_state): если токен не истёк
+    и за последние TOKEN_CHECK_TTL секунд успешно работал с МЭШ — да.
+    Иначе (или при verify=True) пытается вызвать get_users_profile_info()
+    через предохранитель МЭШ. Пока МЭШ недоступен, ответ даёт token_state:
+    токен валиден, если не истёк и МЭШ не отвергал его после последнего успеха.
     """
-    api = AsyncMobileAPI(system=Systems.MES)
-    encrypted_token = load_token_db(telegram_user_id)
-    if encrypted_token:
-        try:
-            token_data = decrypt_token(encrypted_token)
-            api.token = token_data
-            profiles = await api.get_users_profile_info()
-            if profiles:
-                return True
-        except Exception as e:
-            logger.error("Сохранённый токен недействителен для пользователя %s: %s", telegram_user_id, e)
+    try:
+        token_data = await run_db(load_token, telegram_user_id)
+    except Exception as e:
+        logger.error("Не удалось расшифровать токен пользователя %s: %s", telegram_user_id, e)
+        return False
+    if not token_data:
+        return False
+
+    now = time.time()
+    state = await run_db(load_token_state, telegram_user_id)
+    expires_at, last_ok_at, last_failed_at = state or (None, None, None)
+    if expires_at and expires_at <= now:
+        return False
+    if not verify and last_ok_at and now - last_ok_at < TOKEN_CHECK_TTL and (last_failed_at or 0) < last_ok_at:
+        return True
+
+    api = create_api(token_data)
+    try:
+        profiles = await call_mesh(api.get_users_profile_info)
+        if profiles:
+            await run_db(save_token_state, telegram_user_id, token_expiry(token_data), now)
+            return True
+    except MeshUnavailableError:
+        return not last_failed_at or (last_ok_at or 0) > last_failed_at
+    except Exception as e:
+        logger.error("Сохранённый токен недействителен для пользователя %s: %s", telegram_user_id, e)
+        if is_auth_error(e):
+            await run_db(mark_token_used, telegram_user_id, False, now)
     return False
 
 async def get_api_client(telegram_user_id, username=None, password=None):
@@ -76,17 +148,23 @@ async def get_api_client(telegram_user_id, username=None, password=None):
     Возвращает пару (api, sms_code_obj).
     Если sms_code_obj не None, нужна двухфакторная аутентификация.
     """
-    api = AsyncMobileAPI(system=Systems.MES)
-    encrypted_token = load_token_db(telegram_user_id)
+    api = create_api()
 
     # 1) Пробуем использовать сохранённый токен
-    if encrypted_token:
+    try:
+        token_data = await run_db(load_token, telegram_user_id)
+    except Exception as e:
+        logger.error("Не удалось расшифровать токен пользователя %s: %s", telegram_user_id, e)
+        token_data = None
+    if token_data:
         try:
-            token_data = decrypt_token(encrypted_token)
             api.token = token_data
-            profiles = await api.get_users_profile_info()
+            profiles = await call_mesh(api.get_users_profile_info)
             if profiles:
                 return api, None
+        except MeshUnavailableError:
+            # МЭШ недоступен — сохранённый токен не проверяем, сразу полная авторизация
+            pass
         except Exception as e:
             logger.error("Недействительный токен для пользователя %s: %s", telegram_user_id, e)
 
@@ -0,0 +1,76 @@
+# bot/cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+from config import settings
+
+# Фоновое обновление обходит каждого пользователя раз в REFRESH_INTERVAL
+# (см. bot/refresher.py), поэтому токен живёт в кэше дольше одного круга —
+# иначе каждый проход расшифровывает токены заново. Чтобы обход попадал
+# в кэш, TOKEN_CACHE_SIZE должен покрывать пользователей процесса.
+TOKEN_CACHE_SIZE = getattr(settings, 'TOKEN_CACHE_SIZE', 10000)
+TOKEN_CACHE_TTL = getattr(settings, 'TOKEN_CACHE_TTL',
+                          2 * getattr(settings, 'REFRESH_INTERVAL', 3600))
+
+
+class LRUCache:
+    """
+    Ограниченный по размеру (maxsize) LRU-кэш с временем жизни записей (ttl, секунды).
+    Потокобезопасен: к нему обращаются и event loop, и потоки пула БД.
+    Считает попадания и промахи (hits / misses).
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+# Расшифрованные токены по telegram_user_id (см. auth.load_token)
+token_cache = LRUCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
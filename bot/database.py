@@ -1,48 +1,279 @@
 # bot/database.py
 
+import asyncio
+import functools
+import hashlib
+import json
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from config import settings
 from config.settings import DATABASE_PATH
+from .cache import token_cache
+from .lessons import render_day
+
+# Сколько потоков (и, соответственно, долгоживущих соединений) обслуживают БД
+DB_POOL_SIZE = getattr(settings, 'DB_POOL_SIZE', 4)
+# Сколько миллисекунд ждать, пока другой писатель освободит базу
+DB_BUSY_TIMEOUT = getattr(settings, 'DB_BUSY_TIMEOUT', 5000)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='sqlite')
+
+
+def _open_connection():
+    # check_same_thread=False только ради close_db_connections():
+    # работает с соединением всегда один и тот же поток
+    conn = sqlite3.connect(DATABASE_PATH, timeout=DB_BUSY_TIMEOUT / 1000, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT)}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
 
 def get_db_connection():
-    return sqlite3.connect(DATABASE_PATH)
+    """
+    Возвращает долгоживущее соединение текущего потока (WAL + pragmas).
+    Соединение переиспользуется между вызовами — закрывать его не нужно,
+    это делает close_db_connections() при остановке бота.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+async def run_db(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию работы с БД в пуле потоков,
+    чтобы не блокировать event loop бота:
+
+        rows, fetched_at = await run_db(load_schedule_day, user_id, date_str)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def close_db_connections():
+    """
+    Закрывает все открытые соединения и останавливает пул потоков БД.
+    """
+    _executor.shutdown(wait=True)
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.conn = None
 
 def init_db():
     """
-    Создаёт таблицу users (если нет) для хранения токенов.
+    Создаёт таблицу users (если нет) для хранения токенов,
+    таблицу user_identity для кэша профиля/ребёнка из МЭШ
+    и таблицу token_state: срок действия токена и когда он последний раз
+    сработал / был отвергнут МЭШ.
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_user_id INTEGER PRIMARY KEY,
-            encrypted_token BLOB
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                telegram_user_id INTEGER PRIMARY KEY,
+                encrypted_token BLOB
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_identity (
+                telegram_user_id INTEGER PRIMARY KEY,
+                profile_id INTEGER,
+                person_guid TEXT,
+                mes_role TEXT,
+                updated_at REAL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS token_state (
+                telegram_user_id INTEGER PRIMARY KEY,
+                expires_at REAL,
+                last_ok_at REAL,
+                last_failed_at REAL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS refresh_state (
+                telegram_user_id INTEGER PRIMARY KEY,
+                last_active_at REAL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL
+            )
+        ''')
+
+SCHEDULE_TABLE_SQL = '''
+    CREATE TABLE schedule (
+        user_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        lesson_id INTEGER NOT NULL,
+        subject_name TEXT,
+        start_time TEXT,
+        end_time TEXT,
+        homework_text TEXT,
+        room_number TEXT,
+        lesson_theme TEXT,
+        has_cdz INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, date, lesson_id)
+    ) WITHOUT ROWID
+'''
+
 def init_schedule_db():
     """
     Создает таблицу schedule, если ее нет.
     Включаем дополнительные поля:
-      homework_text, room_number, lesson_theme.
+      homework_text, room_number, lesson_theme, has_cdz (к ДЗ прикреплено ЦДЗ).
+    Ключ — (user_id, date, lesson_id), таблица WITHOUT ROWID: строки одного
+    пользователя и дня лежат рядом в B-дереве ключа, поэтому и выборка дня,
+    и удаление по user_id идут по индексу, а не сканом всей таблицы.
+    Старую таблицу без ключа переносим в новую схему.
+    Рядом — таблица schedule_days: когда расписание (user_id, date)
+    последний раз загружалось из МЭШ, хэш его содержимого и готовая
+    отрисовка дня для бота (rendered, JSON — см. lessons.render_day).
     """
+    cutover_cdz = False
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS schedule (
-            user_id INTEGER,
-            date TEXT,
-            lesson_id INTEGER,
-            subject_name TEXT,
-            start_time TEXT,
-            end_time TEXT,
-            homework_text TEXT,
-            room_number TEXT,
-            lesson_theme TEXT
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='schedule'"
         )
-    ''')
-    conn.commit()
-    conn.close()
+        row = cursor.fetchone()
+        if row and 'PRIMARY KEY' not in row[0]:
+            # Миграция со старой схемы (без ключа и индексов)
+            cursor.execute('BEGIN')
+            cursor.execute('ALTER TABLE schedule RENAME TO schedule_legacy')
+            cursor.execute(SCHEDULE_TABLE_SQL)
+            cursor.execute('''
+                INSERT OR REPLACE INTO schedule
+                SELECT user_id, date, lesson_id, subject_name, start_time, end_time,
+                       homework_text, room_number, lesson_theme, 0
+                FROM schedule_legacy
+                WHERE user_id IS NOT NULL AND date IS NOT NULL AND lesson_id IS NOT NULL
+            ''')
+            cursor.execute('DROP TABLE schedule_legacy')
+            cutover_cdz = True
+        elif not row:
+            cursor.execute(SCHEDULE_TABLE_SQL)
+        elif 'has_cdz' not in row[0]:
+            cursor.execute('ALTER TABLE schedule ADD COLUMN has_cdz INTEGER NOT NULL DEFAULT 0')
+            cutover_cdz = True
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schedule_days (
+                user_id INTEGER,
+                date TEXT,
+                fetched_at REAL,
+                content_hash TEXT,
+                rendered TEXT,
+                PRIMARY KEY (user_id, date)
+            )
+        ''')
+        columns = [c[1] for c in cursor.execute('PRAGMA table_info(schedule_days)')]
+        if 'content_hash' not in columns:
+            cursor.execute('ALTER TABLE schedule_days ADD COLUMN content_hash TEXT')
+        if 'rendered' not in columns:
+            cursor.execute('ALTER TABLE schedule_days ADD COLUMN rendered TEXT')
+        if cutover_cdz:
+            # отметок ЦДЗ в старых строках нет — дни перезапишет ближайшее обновление
+            cursor.execute('UPDATE schedule_days SET content_hash = NULL, rendered = NULL')
+
+def init_media_db():
+    """
+    Создаёт таблицу media_cache: file_id, который Telegram выдал
+    при первой загрузке статичной картинки (bot/photo/*.jpg).
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                name TEXT PRIMARY KEY,
+                file_id TEXT
+            )
+        ''')
+
+def load_media_file_ids():
+    """
+    Возвращает {имя файла: file_id} для всех уже загруженных картинок.
+    """
+    conn = get_db_connection()
+    return dict(conn.execute('SELECT name, file_id FROM media_cache').fetchall())
+
+def save_media_file_id(name: str, file_id: str):
+    conn = get_db_connection()
+    with conn:
+        conn.execute('REPLACE INTO media_cache (name, file_id) VALUES (?, ?)', (name, file_id))
+
+def forget_media_file_id(name: str):
+    conn = get_db_connection()
+    with conn:
+        conn.execute('DELETE FROM media_cache WHERE name = ?', (name,))
+
+def init_persistence_db():
+    """
+    Создаёт таблицы для bot.persistence.SQLitePersistence:
+    user_data (JSON по пользователю) и conversations (состояния
+    ConversationHandler по имени и ключу).
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_data (
+                telegram_user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (name, key)
+            ) WITHOUT ROWID
+        ''')
+
+def load_user_data_rows(shard: int = 0, shards: int = 1):
+    """
+    Возвращает [(telegram_user_id, data_json), ...] пользователей шарда
+    (telegram_user_id % shards == shard).
+    """
+    conn = get_db_connection()
+    return conn.execute(
+        'SELECT telegram_user_id, data FROM user_data WHERE telegram_user_id % ? = ?', (shards, shard)
+    ).fetchall()
+
+def load_conversation_rows(name: str):
+    """
+    Возвращает [(key_json, state_json), ...] разговора name.
+    """
+    conn = get_db_connection()
+    return conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+
+def save_persistence_batch(user_rows, user_deletes, conv_rows, conv_deletes):
+    """
+    Записывает накопленные изменения persistence одной транзакцией:
+      user_rows     — [(telegram_user_id, data_json), ...],
+      user_deletes  — [(telegram_user_id,), ...],
+      conv_rows     — [(name, key_json, state_json), ...],
+      conv_deletes  — [(name, key_json), ...] (разговор завершён).
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.executemany('REPLACE INTO user_data (telegram_user_id, data) VALUES (?, ?)', user_rows)
+        conn.executemany('DELETE FROM user_data WHERE telegram_user_id = ?', user_deletes)
+        conn.executemany('REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)', conv_rows)
+        conn.executemany('DELETE FROM conversations WHERE name = ? AND key = ?', conv_deletes)
 
 
 def delete_user_data(telegram_user_id: int):
@@ -50,31 +281,227 @@ def delete_user_data(telegram_user_id: int):
     Удаляет данные пользователя (зашифрованный токен) из базы данных.
     """
     conn = get_db_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM users WHERE telegram_user_id = ?', (telegram_user_id,))
+        cursor.execute('DELETE FROM user_identity WHERE telegram_user_id = ?', (telegram_user_id,))
+        cursor.execute('DELETE FROM token_state WHERE telegram_user_id = ?', (telegram_user_id,))
+        cursor.execute('DELETE FROM refresh_state WHERE telegram_user_id = ?', (telegram_user_id,))
+        cursor.execute('DELETE FROM user_data WHERE telegram_user_id = ?', (telegram_user_id,))
+    token_cache.invalidate(telegram_user_id)
+
+def list_due_users(bucket: int, buckets: int, now: float = None, shard: int = 0, shards: int = 1):
+    """
+    Возвращает пользователей шарда shard (telegram_user_id % shards) из корзины
+    bucket ((telegram_user_id // shards) % buckets), у которых не действует
+    отсрочка после ошибок:
+    [(telegram_user_id, encrypted_token, last_active_at, failures), ...],
+    недавно активные — первыми.
+    """
+    conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE telegram_user_id = ?', (telegram_user_id,))
-    conn.commit()
-    conn.close()
+    cursor.execute('''
+        SELECT u.telegram_user_id, u.encrypted_token, r.last_active_at, COALESCE(r.failures, 0)
+        FROM users u LEFT JOIN refresh_state r ON r.telegram_user_id = u.telegram_user_id
+        WHERE u.telegram_user_id % ? = ?
+          AND (u.telegram_user_id / ?) % ? = ?
+          AND (r.next_attempt_at IS NULL OR r.next_attempt_at <= ?)
+        ORDER BY r.last_active_at DESC
+    ''', (shards, shard, shards, buckets, bucket, now or time.time()))
+    return cursor.fetchall()
+
+def touch_user_activity(telegram_user_id: int, when: float = None):
+    """
+    Отмечает, что пользователь пользовался ботом (для приоритета обновления).
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.execute('''
+            INSERT INTO refresh_state (telegram_user_id, last_active_at) VALUES (?, ?)
+            ON CONFLICT (telegram_user_id) DO UPDATE SET last_active_at = excluded.last_active_at
+        ''', (telegram_user_id, when or time.time()))
+
+def save_refresh_results(results):
+    """
+    Сохраняет итоги фонового обновления одной транзакцией.
+    results — [(telegram_user_id, failures, next_attempt_at), ...];
+    failures=0 и next_attempt_at=None — отсрочки нет.
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO refresh_state (telegram_user_id, failures, next_attempt_at) VALUES (?, ?, ?)
+            ON CONFLICT (telegram_user_id) DO UPDATE SET
+                failures = excluded.failures,
+                next_attempt_at = excluded.next_attempt_at
+        ''', results)
+
+def load_identity(telegram_user_id: int):
+    """
+    Возвращает кэшированную идентичность пользователя в МЭШ
+    (profile_id, person_guid, mes_role, updated_at) или None.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT profile_id, person_guid, mes_role, updated_at
+        FROM user_identity WHERE telegram_user_id = ?
+    ''', (telegram_user_id,))
+    row = cursor.fetchone()
+    return row
+
+def save_identity(telegram_user_id: int, profile_id: int, person_guid: str, mes_role: str):
+    """
+    Сохраняет (или обновляет) идентичность пользователя в МЭШ.
+    """
+    conn = get_db_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            REPLACE INTO user_identity (telegram_user_id, profile_id, person_guid, mes_role, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (telegram_user_id, profile_id, person_guid, mes_role, time.time()))
+
+def invalidate_identity(telegram_user_id: int):
+    """
+    Сбрасывает кэш идентичности (например, после ошибки авторизации).
+    """
+    conn = get_db_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM user_identity WHERE telegram_user_id = ?', (telegram_user_id,))
+
+def load_token_state(telegram_user_id: int):
+    """
+    Возвращает (expires_at, last_ok_at, last_failed_at) токена пользователя или None.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT expires_at, last_ok_at, last_failed_at
+        FROM token_state WHERE telegram_user_id = ?
+    ''', (telegram_user_id,))
+    return cursor.fetchone()
+
+def save_token_state(telegram_user_id: int, expires_at: float = None, last_ok_at: float = None):
+    """
+    Записывает состояние только что полученного токена (при входе)
+    и снимает отсрочку фонового обновления, накопленную старым токеном.
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.execute('''
+            REPLACE INTO token_state (telegram_user_id, expires_at, last_ok_at, last_failed_at)
+            VALUES (?, ?, ?, NULL)
+        ''', (telegram_user_id, expires_at, last_ok_at))
+        conn.execute('''
+            UPDATE refresh_state SET failures = 0, next_attempt_at = NULL
+            WHERE telegram_user_id = ?
+        ''', (telegram_user_id,))
+
+def mark_token_used(telegram_user_id: int, ok: bool, when: float = None):
+    """
+    Отмечает успешный (ok=True) или отвергнутый МЭШ (ok=False) запрос с токеном.
+    """
+    column = 'last_ok_at' if ok else 'last_failed_at'
+    conn = get_db_connection()
+    with conn:
+        conn.execute(f'''
+            INSERT INTO token_state (telegram_user_id, {column}) VALUES (?, ?)
+            ON CONFLICT (telegram_user_id) DO UPDATE SET {column} = excluded.{column}
+        ''', (telegram_user_id, when or time.time()))
 
 def clear_user_schedule(user_id: int):
     """
-    Удаляет все записи расписания пользователя user_id (телеграм-пользователя).
+    Удаляет все записи расписания пользователя user_id (телеграм-пользователя)
+    вместе с отметками свежести.
+    """
+    conn = get_db_connection()
+    with conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM schedule WHERE user_id = ?', (user_id,))
+        cur.execute('DELETE FROM schedule_days WHERE user_id = ?', (user_id,))
+
+def load_schedule_day(user_id: int, date_str: str):
+    """
+    Возвращает (rows, fetched_at) — уроки пользователя на дату date_str
+    из локальной таблицы schedule и время их загрузки из МЭШ
+    (None, если за этот день ещё ничего не загружалось).
     """
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('DELETE FROM schedule WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    cur.execute('''
+        SELECT lesson_id, subject_name, start_time, end_time,
+               homework_text, room_number, lesson_theme, has_cdz
+        FROM schedule
+        WHERE user_id=? AND date=?
+        ORDER BY start_time
+    ''', (user_id, date_str))
+    rows = cur.fetchall()
+    cur.execute(
+        'SELECT fetched_at FROM schedule_days WHERE user_id=? AND date=?',
+        (user_id, date_str)
+    )
+    row = cur.fetchone()
+    return rows, (row[0] if row else None)
 
-def save_events_in_db(user_id: int, events_response):
+def load_rendered_day(user_id: int, date_str: str):
     """
-    Сохраняет список уроков (events) для данного user_id в таблицу schedule.
-    Теперь также записываем room_number и lesson_theme.
+    Возвращает (rendered, fetched_at) — готовую отрисовку дня
+    ([[lesson_id, подпись кнопки, карточка урока], ...], см. lessons.render_day)
+    и время загрузки из МЭШ. rendered — None, если день ещё не отрисован
+    (тогда нужен load_schedule_day).
     """
-    items = events_response.response  # список уроков (Item)
     conn = get_db_connection()
-    cursor = conn.cursor()
+    row = conn.execute(
+        'SELECT rendered, fetched_at FROM schedule_days WHERE user_id=? AND date=?',
+        (user_id, date_str)
+    ).fetchone()
+    if not row:
+        return None, None
+    return (json.loads(row[0]) if row[0] is not None else None), row[1]
+
+UPSERT_LESSON_SQL = '''
+    INSERT INTO schedule (
+        user_id,
+        date,
+        lesson_id,
+        subject_name,
+        start_time,
+        end_time,
+        homework_text,
+        room_number,
+        lesson_theme,
+        has_cdz
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, date, lesson_id) DO UPDATE SET
+        subject_name = excluded.subject_name,
+        start_time = excluded.start_time,
+        end_time = excluded.end_time,
+        homework_text = excluded.homework_text,
+        room_number = excluded.room_number,
+        lesson_theme = excluded.lesson_theme,
+        has_cdz = excluded.has_cdz
+    WHERE subject_name IS NOT excluded.subject_name
+       OR start_time IS NOT excluded.start_time
+       OR end_time IS NOT excluded.end_time
+       OR homework_text IS NOT excluded.homework_text
+       OR room_number IS NOT excluded.room_number
+       OR lesson_theme IS NOT excluded.lesson_theme
+       OR has_cdz IS NOT excluded.has_cdz
+'''
 
-    for event in items:
+def events_to_rows(user_id: int, events_response):
+    """
+    Готовит строки для таблицы schedule из ответа get_events (без обращения к БД):
+    [(user_id, date, lesson_id, subject_name, start_time, end_time,
+      homework_text, room_number, lesson_theme, has_cdz), ...]
+    """
+    rows = []
+    for event in events_response.response or []:  # список уроков (Item)
+        if event.id is None:
+            continue
         dt_str = ""
         start_str = ""
         end_str = ""
@@ -84,43 +511,158 @@ def save_events_in_db(user_id: int, events_response):
         if event.finish_at:
             end_str = event.finish_at.strftime('%H:%M')
 
-        subject = event.subject_name or ""
-        lesson_id = event.id
-
         # Домашка
         hw_text = None
         if event.homework and event.homework.descriptions:
             hw_text = "\n".join(event.homework.descriptions)
 
-        # Новые поля
-        room = event.room_number or ""
-        theme = event.lesson_theme or ""
-
-        cursor.execute('''
-            INSERT INTO schedule (
-                user_id,
-                date,
-                lesson_id,
-                subject_name,
-                start_time,
-                end_time,
-                homework_text,
-                room_number,
-                lesson_theme
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        rows.append((
             user_id,
             dt_str,
-            lesson_id,
-            subject,
+            event.id,
+            event.subject_name or "",
             start_str,
             end_str,
             hw_text,
-            room,
-            theme
+            event.room_number or "",
+            event.lesson_theme or "",
+            int(bool(getattr(event, 'materials', None))),
         ))
+    return rows
+
+def _day_hash(day_rows):
+    """
+    Хэш содержимого одного дня (строки schedule без user_id и date,
+    включая отметку ЦДЗ).
+    """
+    h = hashlib.sha1()
+    for row in sorted(day_rows, key=lambda r: r[2]):
+        h.update(repr(row[2:]).encode())
+    return h.hexdigest()
+
+def _replace_user_window(cur, user_id: int, rows, begin_date: date, end_date: date,
+                         purge_before: date = None, replace_all: bool = False):
+    """
+    Заменяет расписание user_id за [begin_date, end_date] готовыми строками rows
+    в уже открытой транзакции. Для каждого дня окна считается хэш содержимого;
+    уроки пишутся только в днях, где хэш изменился:
+      - upsert изменившихся уроков одним executemany,
+      - удаление уроков дня, которых больше нет в МЭШ.
+    Для всех дней окна обновляются fetched_at и content_hash; изменившиеся
+    (и ещё не отрисованные) дни заодно отрисовываются (rendered), так что
+    показ дня в боте потом не собирает подписи заново.
+    При purge_before удаляются уроки старше этой даты.
+    При replace_all (вход мог быть под другим аккаунтом) удаляется всё
+    расписание пользователя вне окна, а хэши дней окна не учитываются —
+    каждый день окна перезаписывается целиком.
+    Возвращает число изменившихся дней.
+    """
+    by_date = {}
+    for row in rows:
+        by_date.setdefault(row[1], []).append(row)
 
-    conn.commit()
-    conn.close()
+    period = (user_id, begin_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    cur.execute('''
+        SELECT date, content_hash, rendered IS NOT NULL
+        FROM schedule_days WHERE user_id = ? AND date BETWEEN ? AND ?
+    ''', period)
+    old_days = {day: (content_hash, has_render) for day, content_hash, has_render in cur.fetchall()}
+    if replace_all:
+        old_days = {}
+        cur.execute('DELETE FROM schedule WHERE user_id = ? AND (date < ? OR date > ?)', period)
+        cur.execute('DELETE FROM schedule_days WHERE user_id = ? AND (date < ? OR date > ?)', period)
 
+    now = time.time()
+    days_state = []
+    changed = []
+    for i in range((end_date - begin_date).days + 1):
+        day = (begin_date + timedelta(days=i)).strftime('%Y-%m-%d')
+        day_rows = by_date.get(day, [])
+        content_hash = _day_hash(day_rows)
+        old_hash, has_render = old_days.get(day, (None, False))
+        rendered = None
+        if old_hash != content_hash or not has_render:
+            rendered = json.dumps(render_day(day_rows), ensure_ascii=False)
+        days_state.append((user_id, day, now, content_hash, rendered))
+        if old_hash != content_hash:
+            changed.append(day)
+
+    for day in changed:
+        day_rows = by_date.get(day, [])
+        cur.executemany(UPSERT_LESSON_SQL, day_rows)
+        keep_ids = {row[2] for row in day_rows}
+        cur.execute('SELECT lesson_id FROM schedule WHERE user_id = ? AND date = ?', (user_id, day))
+        cur.executemany(
+            'DELETE FROM schedule WHERE user_id = ? AND date = ? AND lesson_id = ?',
+            [(user_id, day, lid) for (lid,) in cur.fetchall() if lid not in keep_ids]
+        )
+
+    if purge_before:
+        cutoff = (user_id, purge_before.strftime('%Y-%m-%d'))
+        cur.execute('DELETE FROM schedule WHERE user_id = ? AND date < ?', cutoff)
+        cur.execute('DELETE FROM schedule_days WHERE user_id = ? AND date < ?', cutoff)
+
+    cur.executemany('''
+        INSERT INTO schedule_days (user_id, date, fetched_at, content_hash, rendered)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, date) DO UPDATE SET
+            fetched_at = excluded.fetched_at,
+            content_hash = excluded.content_hash,
+            rendered = COALESCE(excluded.rendered, schedule_days.rendered)
+    ''', days_state)
+    return len(changed)
+
+def store_user_schedule(user_id: int, events_response, begin_date: date, end_date: date,
+                        purge_before: date = None, replace_all: bool = False):
+    """
+    Атомарно заменяет расписание user_id за [begin_date, end_date] свежим ответом МЭШ:
+    запись изменившихся дней, удаление исчезнувших уроков, отметка свежести
+    (при purge_before — удаление старых дней, при replace_all — всего вне окна)
+    — всё в одной транзакции, так что читатели никогда не видят
+    промежуточного (пустого) расписания.
+    Возвращает число изменившихся дней.
+    """
+    return store_user_schedules([(user_id, events_to_rows(user_id, events_response),
+                                  begin_date, end_date, purge_before, replace_all)])
+
+def store_user_schedules(batch):
+    """
+    Записывает расписания нескольких пользователей одной транзакцией (один fsync).
+    batch — список (user_id, rows, begin_date, end_date, purge_before, replace_all),
+    где rows получены из events_to_rows().
+    Возвращает общее число изменившихся дней.
+    """
+    changed = 0
+    conn = get_db_connection()
+    with conn:
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        for (user_id, rows, begin_date, end_date, purge_before, replace_all) in batch:
+            changed += _replace_user_window(cur, user_id, rows, begin_date, end_date,
+                                            purge_before, replace_all)
+    return changed
+
+# Сколько user_id подставляется в один запрос WHERE user_id IN (...)
+FETCH_TIMES_CHUNK = 500
+
+def load_fetch_times(user_ids, begin_date: date, end_date: date):
+    """
+    Возвращает {user_id: {date: fetched_at}} пользователей user_ids за период —
+    для планирования фонового обновления. Читаются только строки этих
+    пользователей (по ключу (user_id, date), пачками по FETCH_TIMES_CHUNK id),
+    а не вся таблица schedule_days.
+    """
+    period = (begin_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    user_ids = list(user_ids)
+    conn = get_db_connection()
+    result = {}
+    for i in range(0, len(user_ids), FETCH_TIMES_CHUNK):
+        chunk = user_ids[i:i + FETCH_TIMES_CHUNK]
+        cur = conn.execute(
+            f'SELECT user_id, date, fetched_at FROM schedule_days '
+            f'WHERE user_id IN ({",".join("?" * len(chunk))}) AND date BETWEEN ? AND ?',
+            (*chunk, *period)
+        )
+        for (user_id, day, fetched_at) in cur:
+            result.setdefault(user_id, {})[day] = fetched_at
+    return result
@@ -1,8 +1,8 @@
 # bot/handlers.py
 
 import logging
-import re
-from datetime import datetime, date, timedelta
+import time
+from datetime import date, timedelta
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -14,6 +14,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
@@ -22,29 +23,51 @@ from .auth import (
     is_user_logged_in,
     get_api_client,
     save_token_db,
-    load_token_db,
+    load_token,
     encrypt_token,
-    decrypt_token,
+    token_expiry,
 )
 from .database import (
-    get_db_connection,
-    # init_db, init_schedule_db, clear_user_schedule, save_events_in_db,
+    # init_db, init_schedule_db, clear_user_schedule,
     delete_user_data,
+    invalidate_identity,
+    load_schedule_day,
+    load_rendered_day,
+    save_token_state,
+    run_db,
 )
+from .mesh import create_api, get_user_events, NoIdentityError, breaker
+from .refresher import refresh_user_days, note_activity
+from .media import show_photo
+from .lessons import lessons_from_events, lessons_from_rows, lessons_from_render
+from .router import CallbackRouter
 from .utils import generate_calendar_keyboard, compute_21days
-from octodiary.apis import AsyncMobileAPI
-from octodiary.urls import Systems
 from octodiary.types.enter_sms_code import EnterSmsCode
+from config import settings
 
 logger = logging.getLogger(__name__)
 
+# Свежесть локального расписания (секунды): моложе FRESH_TTL — отдаём как есть,
+# моложе MAX_STALE — отдаём и обновляем в фоне, старше — идём в МЭШ сразу.
+SCHEDULE_FRESH_TTL = getattr(settings, 'SCHEDULE_FRESH_TTL', 15 * 60)
+SCHEDULE_MAX_STALE = getattr(settings, 'SCHEDULE_MAX_STALE', 24 * 3600)
+
+# Пометка в ответе, когда МЭШ недоступен и показаны локальные данные
+STALE_NOTE = "⚠️ МЭШ сейчас недоступен, данные могут быть устаревшими."
+
 # Состояния для ConversationHandler (логин)
 USERNAME, PASSWORD, SMS_CODE = range(3)
 
+# Маршруты callback_data (заполняются в setup_handlers); stats() — время по маршрутам
+callback_router = CallbackRouter()
+
 def setup_handlers(application):
     """
     Регистрируем все необходимые хендлеры в Application.
     """
+    # Отмечаем активность пользователя (приоритет фонового обновления)
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
+
     # Создаем ConversationHandler для логина
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('login', login)],
@@ -54,14 +77,34 @@ def setup_handlers(application):
             SMS_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_sms_code)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='login',
+        persistent=True,  # состояние входа переживает перезапуск (см. bot.persistence)
     )
 
     application.add_handler(CommandHandler('start', start))
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('schedule', schedule))
 
-    # Обработчик всех колбэков (callback_data)
-    application.add_handler(CallbackQueryHandler(handle_callback_query))
+    # Обработчик всех колбэков (callback_data) — таблица маршрутов
+    callback_router.add('cal21_day_', calendar_day, int)
+    callback_router.add('cal21_prev_', calendar_prev, int)
+    callback_router.add('cal21_next_', calendar_next, int)
+    callback_router.add('lesson_', lesson_detail, int)
+    callback_router.add('back_to_schedule', back_to_schedule)
+    callback_router.add('back_to_lessons', back_to_lessons)
+    callback_router.add('delete_my_data', delete_my_data)
+    callback_router.add('view_schedule', schedule)
+    callback_router.fallback = unknown_callback
+    application.add_handler(CallbackQueryHandler(callback_router.dispatch))
+
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Запоминает, что пользователь пользуется ботом. Ничего не отвечает,
+    остальные хендлеры обрабатывают апдейт как обычно.
+    """
+    if update.effective_user:
+        await note_activity(update.effective_user.id)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -125,8 +168,12 @@ async def get_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Пожалуйста, подождите, идёт авторизация...')
 
     telegram_user_id = update.effective_user.id
-    username = context.user_data['username']
-    password = context.user_data['password']
+    # Логин и пароль больше не нужны — не держим их в user_data (и в persistence)
+    username = context.user_data.pop('username', None)
+    password = context.user_data.pop('password')
+    if not username:
+        await update.message.reply_text('Время входа истекло. Попробуйте снова /login.')
+        return ConversationHandler.END
     api, sms_code_obj = await get_api_client(telegram_user_id, username, password)
 
     if api is None:
@@ -150,26 +197,20 @@ async def sync_user_schedule(tg_id: int, context: ContextTypes.DEFAULT_TYPE):
     Синхронизирует расписание одного пользователя (tg_id) из МЭШ в локальную БД.
     Смысл - вызвать, когда пользователь впервые залогинился.
     """
-    from .database import clear_user_schedule, save_events_in_db
-    from bot.auth import decrypt_token
-    from octodiary.apis import AsyncMobileAPI
-    from octodiary.urls import Systems
+    from .database import store_user_schedule
 
     logger = logging.getLogger(__name__)
 
-    # 1) Берём зашифрованный токен из БД
-    enc_token = load_token_db(tg_id)
-    if not enc_token:
-        logger.warning(f"У пользователя {tg_id} нет токена, пропускаем sync_user_schedule.")
-        return
-
+    # 1) Берём токен (из кэша или из БД)
     try:
-        token_data = decrypt_token(enc_token)
-        mesh_api = AsyncMobileAPI(system=Systems.MES)
-        mesh_api.token = token_data
+        token_data = await run_db(load_token, tg_id)
     except Exception as e:
         logger.warning(f"Ошибка расшифровки токена при sync_user_schedule(tg_id={tg_id}): {e}")
         return
+    if not token_data:
+        logger.warning(f"У пользователя {tg_id} нет токена, пропускаем sync_user_schedule.")
+        return
+    mesh_api = create_api(token_data)
 
     # 2) Вызываем API MЭШ, например, на 7 дней назад и 7 дней вперёд
     today = date.today()
@@ -177,45 +218,34 @@ async def sync_user_schedule(tg_id: int, context: ContextTypes.DEFAULT_TYPE):
     end_date = today + timedelta(days=7)
 
     try:
-        profiles = await mesh_api.get_users_profile_info()
-        if not profiles:
-            logger.warning(f"Нет профилей у {tg_id}, не можем синхронизировать.")
-            return
-        first_profile = profiles[0]
-        fam = await mesh_api.get_family_profile(profile_id=first_profile.id)
-        if not fam.children:
-            logger.warning(f"У пользователя {tg_id} нет children, пропускаем.")
-            return
-
-        child = fam.children[0]
-        person_guid = child.contingent_guid
-        mes_role = fam.profile.type
-
-        events = await mesh_api.get_events(
-            person_id=person_guid,
-            mes_role=mes_role,
-            begin_date=begin_date,
-            end_date=end_date
-        )
+        events = await get_user_events(mesh_api, tg_id, begin_date, end_date)
 
-        # 3) Очищаем расписание, сохраняем свежее
-        clear_user_schedule(tg_id)
-        save_events_in_db(tg_id, events)
+        # 3) Заменяем всё расписание свежим одной транзакцией (вход мог быть под другим аккаунтом)
+        await run_db(store_user_schedule, tg_id, events, begin_date, end_date, replace_all=True)
 
         logger.info(f"Синхронизация расписания user_id={tg_id} завершена успешно.")
+    except NoIdentityError as e:
+        logger.warning(f"{e}, не можем синхронизировать.")
     except Exception as e:
         logger.warning(f"Ошибка при синхронизации user_id={tg_id}: {e}")
 
 async def get_sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sms_code = update.message.text
     telegram_user_id = update.effective_user.id
-    api = context.user_data['api']
-    sms_code_obj = context.user_data['sms_code_obj']
+    api = context.user_data.get('api')
+    sms_code_obj = context.user_data.get('sms_code_obj')
+    if not (api and sms_code_obj):
+        # Бот перезапускался во время входа — объект ввода кода не сохраняется
+        await update.message.reply_text('Время ввода кода истекло. Попробуйте снова с помощью команды /login.')
+        return ConversationHandler.END
 
     try:
         api.token = await sms_code_obj.async_enter_code(sms_code)
         encrypted_token = encrypt_token(api.token)
-        save_token_db(telegram_user_id, encrypted_token)
+        await run_db(save_token_db, telegram_user_id, encrypted_token)
+        await run_db(save_token_state, telegram_user_id, token_expiry(api.token), time.time())
+        # Новый вход может быть под другим аккаунтом — профиль определим заново
+        await run_db(invalidate_identity, telegram_user_id)
     except Exception as e:
         logger.error("Ошибка при вводе SMS-кода для пользователя %s: %s", telegram_user_id, e)
         await update.message.reply_text(
@@ -231,31 +261,38 @@ async def get_sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def get_user_api(context: ContextTypes.DEFAULT_TYPE, telegram_user_id: int):
+    """
+    Возвращает API-клиент пользователя из user_data, а если его там нет
+    (например, после перезапуска бота) — создаёт по сохранённому токену.
+    None — токена нет; ошибка расшифровки пробрасывается.
+    """
+    api = context.user_data.get('api')
+    if not api:
+        token_data = await run_db(load_token, telegram_user_id)
+        if not token_data:
+            return None
+        api = context.user_data['api'] = create_api(token_data)
+    return api
+
+
 async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /schedule — показываем календарь (21 день, offset=7 => текущая неделя),
     прикрепляя 1.jpg ("Выберите дату").
     """
     telegram_user_id = update.effective_user.id
-    api = context.user_data.get('api')
-
+    try:
+        api = await get_user_api(context, telegram_user_id)
+    except Exception as e:
+        logger.error("Ошибка при дешифровании токена: %s", e)
+        await update.effective_message.reply_text(
+            'Сессия истекла. Пожалуйста, /login снова.'
+        )
+        return
     if not api:
-        encrypted_token = load_token_db(telegram_user_id)
-        if encrypted_token:
-            try:
-                token_data = decrypt_token(encrypted_token)
-                api_local = AsyncMobileAPI(system=Systems.MES)
-                api_local.token = token_data
-                context.user_data['api'] = api_local
-            except Exception as e:
-                logger.error("Ошибка при дешифровании токена: %s", e)
-                await update.effective_message.reply_text(
-                    'Сессия истекла. Пожалуйста, /login снова.'
-                )
-                return
-        else:
-            await update.effective_message.reply_text('Пожалуйста, выполните /login.')
-            return
+        await update.effective_message.reply_text('Пожалуйста, выполните /login.')
+        return
 
     # Предупреждение
     await update.effective_message.reply_text(
@@ -265,84 +302,139 @@ async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Формируем календарь
     markup = generate_calendar_keyboard(offset=7)  # Текущая неделя
 
-    # Удаляем предыдущее сообщение, отправляем фото 1.jpg
-    await update.effective_message.delete()
-    with open("bot/photo/1.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=f,
-            caption="Выберите дату",
-            reply_markup=markup
-        )
+    # Заменяем предыдущее сообщение на фото 1.jpg
+    await show_photo(
+        context.bot,
+        update.effective_message,
+        "1.jpg",
+        caption="Выберите дату",
+        reply_markup=markup
+    )
+
+
+async def calendar_day(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: int):
+    await process_calendar_day(update.callback_query, context, idx)
+
+
+async def calendar_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, old_offset: int):
+    await show_calendar(update.callback_query, context, max(0, old_offset - 5))
+
+
+async def calendar_next(update: Update, context: ContextTypes.DEFAULT_TYPE, old_offset: int):
+    new_offset = old_offset + 5
+    if new_offset >= 21:
+        new_offset = 16
+    await show_calendar(update.callback_query, context, new_offset)
+
+
+async def show_calendar(query, context, offset: int):
+    markup = generate_calendar_keyboard(offset=offset)
+
+    await show_photo(
+        context.bot,
+        query.message,
+        "1.jpg",
+        caption="Выберите дату",
+        reply_markup=markup
+    )
 
 
-async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def unknown_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data
-    logger.info("callback_data: %s", data)
+    logger.warning("Неизвестный callback_data: %s", query.data)
+    await query.answer("Неизвестный ввод")
 
-    match_day = re.match(r'^cal21_day_(\d+)$', data)
-    if match_day:
-        idx = int(match_day.group(1))
-        await process_calendar_day(query, context, idx)
-        return
 
-    match_prev = re.match(r'^cal21_prev_(\d+)$', data)
-    if match_prev:
-        old_offset = int(match_prev.group(1))
-        new_offset = max(0, old_offset - 5)
-        markup = generate_calendar_keyboard(offset=new_offset)
+def lessons_keyboard(lessons) -> InlineKeyboardMarkup:
+    """
+    Кнопки уроков дня (lesson_X — номер в списке) и возврат к календарю.
+    """
+    keyboard = [
+        [InlineKeyboardButton(lesson.button_text(), callback_data=f"lesson_{idx}")]
+        for idx, lesson in enumerate(lessons)
+        if lesson is not None
+    ]
+    keyboard.append([InlineKeyboardButton("Вернуться к расписанию", callback_data='back_to_schedule')])
+    return InlineKeyboardMarkup(keyboard)
 
-        await query.message.delete()
-        with open("bot/photo/1.jpg", "rb") as f:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=f,
-                caption="Выберите дату",
-                reply_markup=markup
-            )
-        return
 
-    match_next = re.match(r'^cal21_next_(\d+)$', data)
-    if match_next:
-        old_offset = int(match_next.group(1))
-        new_offset = old_offset + 5
-        if new_offset >= 21:
-            new_offset = 16
-        markup = generate_calendar_keyboard(offset=new_offset)
+def set_lessons(context: ContextTypes.DEFAULT_TYPE, date_str: str, lessons):
+    """
+    Запоминает показанный список уроков. Сами уроки живут только в памяти,
+    а в persistence попадают ссылки: дата и id уроков (см. UserData).
+    """
+    context.user_data['lessons'] = lessons
+    context.user_data['lessons_date'] = date_str
+    context.user_data['lesson_ids'] = [lesson.id for lesson in lessons]
 
-        await query.message.delete()
-        with open("bot/photo/1.jpg", "rb") as f:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=f,
-                caption="Выберите дату",
-                reply_markup=markup
-            )
+
+async def get_lessons(context: ContextTypes.DEFAULT_TYPE, telegram_user_id: int):
+    """
+    Возвращает последний показанный список уроков. Если в памяти его нет
+    (бот перезапускался), собирает из таблицы schedule по сохранённым id;
+    урок, которого в БД уже нет, остаётся на своём месте как None,
+    чтобы номера в callback_data (lesson_X) не сдвигались.
+    """
+    lessons = context.user_data.get('lessons')
+    if lessons is None and context.user_data.get('lesson_ids'):
+        day_lessons, _ = await load_day_lessons(telegram_user_id, context.user_data['lessons_date'])
+        by_id = {lesson.id: lesson for lesson in day_lessons}
+        lessons = [by_id.get(lid) for lid in context.user_data['lesson_ids']]
+        context.user_data['lessons'] = lessons
+    return lessons
+
+
+async def load_day_lessons(telegram_user_id: int, date_str: str):
+    """
+    Возвращает (lessons, fetched_at) — уроки дня из локальной БД.
+    Обычно это готовая отрисовка, сохранённая при синхронизации
+    (load_rendered_day): подписи кнопок и карточки уже собраны.
+    Если день ещё не отрисован — собирает уроки из строк schedule.
+    """
+    rendered, fetched_at = await run_db(load_rendered_day, telegram_user_id, date_str)
+    if rendered is not None:
+        return lessons_from_render(rendered), fetched_at
+    rows, fetched_at = await run_db(load_schedule_day, telegram_user_id, date_str)
+    return lessons_from_rows(rows), fetched_at
+
+
+# (user_id, date) дней, которые сейчас обновляются в фоне
+_revalidating = set()
+
+def revalidate_day(context, api, telegram_user_id: int, day: date):
+    """
+    Запускает фоновое обновление расписания пользователя за один день,
+    не задерживая ответ. Повторный вызов для того же дня, пока первый
+    ещё идёт, ничего не делает.
+    """
+    key = (telegram_user_id, day)
+    if key in _revalidating:
         return
+    _revalidating.add(key)
 
-    if data == 'back_to_schedule':
-        await back_to_schedule(update, context)
-    elif data == 'back_to_lessons':
-        await back_to_lessons(update, context)
-    elif data == 'delete_my_data':
-        await delete_my_data(update, context)
-    elif data == 'view_schedule':
-        await schedule(update, context)
-    elif data.startswith('lesson_'):
-        await lesson_detail(update, context)
-    else:
-        logger.warning("Неизвестный callback_data: %s", data)
-        await query.answer("Неизвестный ввод")
+    async def _revalidate():
+        try:
+            await refresh_user_days(api, telegram_user_id, day, day)
+        except Exception as e:
+            logger.warning(f"Фоновое обновление {day} для user_id={telegram_user_id} не удалось: {e}")
+        finally:
+            _revalidating.discard(key)
+
+    context.application.create_task(_revalidate())
 
 
 async def process_calendar_day(query, context, day_index: int):
     """
     Когда пользователь выбрал дату (cal21_day_X):
-      - Пытаемся получить расписание из МЭШ.
-      - Если ошибка => fallback из локальной БД (schedule).
+      - Если день есть в локальной БД (schedule) и загружен не раньше
+        SCHEDULE_MAX_STALE секунд назад — отвечаем из неё; старше
+        SCHEDULE_FRESH_TTL — дополнительно обновляем день в фоне.
+      - Иначе получаем расписание из МЭШ (и сохраняем в БД).
+      - Если ошибка или предохранитель МЭШ открыт => fallback из локальной
+        БД (schedule) без ожидания МЭШ, с пометкой STALE_NOTE.
       - Независимо от fallback или нет, прикрепляем фото 2.jpg: "Выберите урок на <дата>".
-      - Сохраняем ДЗ в lessons (fallback) через homework_text.
+      - Обе ветки дают список уроков (LessonView или заранее отрисованные
+        RenderedLesson), он запоминается через set_lessons.
     """
     await query.answer()
 
@@ -360,7 +452,11 @@ async def process_calendar_day(query, context, day_index: int):
     chosen_date_str = chosen_date.strftime("%d.%m.%Y")
 
     telegram_user_id = query.from_user.id
-    api = context.user_data.get('api')
+    try:
+        api = await get_user_api(context, telegram_user_id)
+    except Exception as e:
+        logger.error("Ошибка при дешифровании токена: %s", e)
+        api = None
 
     if not api:
         await query.message.delete()
@@ -370,61 +466,34 @@ async def process_calendar_day(query, context, day_index: int):
         )
         return
 
-    # Попробуем MЭШ
-    try:
-        profiles = await api.get_users_profile_info()
-        profile_id = profiles[0].id
-
-        family = await api.get_family_profile(profile_id=profile_id)
-        mes_role = family.profile.type
-        child = family.children[0]
-        person_guid = child.contingent_guid
-
-        events = await api.get_events(
-            person_id=person_guid,
-            mes_role=mes_role,
-            begin_date=chosen_date,
-            end_date=chosen_date
-        )
-        mesh_lessons = [
-            ev for ev in events.response
-            if ev.subject_name and ev.start_at and ev.finish_at
-        ]
-        lessons = mesh_lessons
+    # Сначала локальная БД (готовая отрисовка дня): если день загружался
+    # недавно, отвечаем сразу, а при необходимости обновляем его в фоне.
+    local_lessons, fetched_at = await load_day_lessons(telegram_user_id, date_str)
+    age = time.time() - fetched_at if fetched_at else None
+
+    stale = False
+    if age is not None and age < SCHEDULE_MAX_STALE:
+        lessons = local_lessons
+        if age >= SCHEDULE_FRESH_TTL:
+            if breaker.is_open():
+                stale = True
+            else:
+                revalidate_day(context, api, telegram_user_id, chosen_date)
+    elif breaker.is_open():
+        # МЭШ недоступен — не ждём таймаута, сразу отдаём что есть локально
+        lessons = local_lessons
+        stale = True
+    else:
+        # Локальных данных нет или они слишком старые — идём в МЭШ
+        try:
+            events = await refresh_user_days(api, telegram_user_id, chosen_date, chosen_date)
+            lessons = lessons_from_events(events)
 
-    except Exception as e:
-        logger.error(f"MЭШ недоступен: {e}")
-        # fallback
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT lesson_id, subject_name, start_time, end_time,
-                   homework_text, room_number, lesson_theme
-            FROM schedule
-            WHERE user_id=? AND date=?
-            ORDER BY start_time
-        ''', (telegram_user_id, date_str))
-        rows = cur.fetchall()
-        conn.close()
-
-        class FakeEvent: pass
-        lessons = []
-        for (lid, subj, st, et, hw_text, r_num, l_theme) in rows:
-            fe = FakeEvent()
-
-            fe.id = lid
-            fe.subject_name = subj
-            fe.start_at = datetime.strptime(st, '%H:%M') if st else None
-            fe.finish_at = datetime.strptime(et, '%H:%M') if et else None
-            fe.homework_text = hw_text
-
-            # <-- ВАЖНО: сохраняем колонку room_number в fe.room_number
-            fe.room_number = r_num if r_num else None
-            # <-- Сохраняем lesson_theme
-            fe.lesson_theme = l_theme if l_theme else None
-
-            # при желании: fe.materials = None
-            lessons.append(fe)
+        except Exception as e:
+            logger.error(f"MЭШ недоступен: {e}")
+            # fallback: что есть в локальной БД, независимо от возраста
+            lessons = local_lessons
+            stale = True
 
     if not lessons:
         await query.message.delete()
@@ -434,94 +503,42 @@ async def process_calendar_day(query, context, day_index: int):
         )
         return
 
-    # Формируем inline-кнопки
-    keyboard = []
-    for idx, ev in enumerate(lessons):
-        if getattr(ev, "start_at", None):
-            st_t = ev.start_at.strftime('%H:%M')
-        else:
-            st_t = "--:--"
-        if getattr(ev, "finish_at", None):
-            et_t = ev.finish_at.strftime('%H:%M')
-        else:
-            et_t = "--:--"
-        subj = ev.subject_name or '---'
-        btn_txt = f"{st_t}-{et_t} {subj}"
-        callback_data = f"lesson_{idx}"
-        keyboard.append([InlineKeyboardButton(btn_txt, callback_data=callback_data)])
+    reply_markup = lessons_keyboard(lessons)
+    set_lessons(context, date_str, lessons)
 
-    keyboard.append([InlineKeyboardButton("Вернуться к расписанию", callback_data='back_to_schedule')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.user_data['lessons'] = lessons
+    caption = f"Выберите урок на {chosen_date_str}:"
+    if stale:
+        caption += "\n" + STALE_NOTE
 
-    # Удаляем старое сообщение и отправляем 2.jpg => "Выберите урок на ..."
-    await query.message.delete()
-    with open("bot/photo/2.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption=f"Выберите урок на {chosen_date_str}:",
-            reply_markup=reply_markup
-        )
+    # Меняем сообщение на 2.jpg => "Выберите урок на ..."
+    await show_photo(
+        context.bot,
+        query.message,
+        "2.jpg",
+        caption=caption,
+        reply_markup=reply_markup
+    )
 
 
-async def lesson_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def lesson_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, lesson_index: int):
     """
     Когда пользователь выбрал конкретный урок (lesson_X).
-    Показываем домашку. Если fallback => event.homework_text, иначе event.homework.descriptions.
+    Показываем карточку урока с домашкой (LessonView.caption).
     """
     query = update.callback_query
     await query.answer()
-    data = query.data
 
-    lessons = context.user_data.get('lessons')
-    lesson_index = int(data.split('_')[1])
-    event = lessons[lesson_index]
-
-    # Собираем сообщение
-    start_time = getattr(event, 'start_at', None)
-    finish_time = getattr(event, 'finish_at', None)
-    st_str = start_time.strftime('%H:%M') if start_time else 'Не указано'
-    et_str = finish_time.strftime('%H:%M') if finish_time else 'Не указано'
-    subject = getattr(event, 'subject_name', 'Не указано')
-    room = getattr(event, 'room_number', 'Не указан')
-    theme = getattr(event, 'lesson_theme', 'Не указана')
-
-    message = (
-        f"⏰ {st_str}-{et_str}\n"
-        f"📚 Предмет: {subject}\n"
-        f"🚪 Кабинет: {room}\n"
-        f"📖 Тема урока: {theme}\n"
-    )
+    lessons = await get_lessons(context, query.from_user.id)
+    lesson = lessons[lesson_index] if lessons and 0 <= lesson_index < len(lessons) else None
+    if lesson is None:
+        await query.message.delete()
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text='Ошибка: урок не найден. Выберите дату заново: /schedule'
+        )
+        return
 
-    # ДЗ: если fallback => event.homework_text, иначе event.homework.descriptions
-    fallback_hw = getattr(event, 'homework_text', None)
-    if fallback_hw is not None:
-        # fallback
-        fallback_hw = fallback_hw.strip()
-        if fallback_hw:
-            message += "📝 Домашнее задание:\n" + fallback_hw + "\n"
-        else:
-            message += "📝 Домашнее задание: нет\n"
-    else:
-        # normal event
-        if getattr(event, "homework", None) and event.homework.descriptions:
-            message += "📝 Домашнее задание:\n"
-            for desc in event.homework.descriptions:
-                message += f"- {desc}\n"
-        else:
-            message += "📝 Домашнее задание: нет\n"
-
-    # ЦДЗ
-    has_cdz = False
-    if fallback_hw is None:
-        # normal event => check event.materials
-        if getattr(event, "materials", None):
-            has_cdz = True
-    # (Если fallback, materials=None => has_cdz=False, либо вы можете хранить info)
-
-    if has_cdz:
-        message += "💻 Учитель прикрепил ЦДЗ к ДЗ.\n"
+    message = lesson.caption()
 
     keyboard = [
         [InlineKeyboardButton("Вернуться к урокам", callback_data='back_to_lessons')],
@@ -529,14 +546,13 @@ async def lesson_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.message.delete()
-    with open("bot/photo/3.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption=message,
-            reply_markup=reply_markup
-        )
+    await show_photo(
+        context.bot,
+        query.message,
+        "3.jpg",
+        caption=message,
+        reply_markup=reply_markup
+    )
 
 
 async def back_to_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -546,7 +562,7 @@ async def back_to_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    lessons = context.user_data.get('lessons')
+    lessons = await get_lessons(context, query.from_user.id)
     if not lessons:
         await query.message.delete()
         await context.bot.send_message(
@@ -555,27 +571,15 @@ async def back_to_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Генерируем inline-кнопки по урокам
-    keyboard = []
-    for idx, ev in enumerate(lessons):
-        st_t = ev.start_at.strftime('%H:%M') if ev.start_at else '--:--'
-        et_t = ev.finish_at.strftime('%H:%M') if ev.finish_at else '--:--'
-        subj = ev.subject_name or '---'
-        btn_txt = f"{st_t}-{et_t} {subj}"
-        callback_data = f"lesson_{idx}"
-        keyboard.append([InlineKeyboardButton(btn_txt, callback_data=callback_data)])
-
-    keyboard.append([InlineKeyboardButton("Вернуться к расписанию", callback_data='back_to_schedule')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = lessons_keyboard(lessons)
 
-    await query.message.delete()
-    with open("bot/photo/2.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption="Выберите урок:",
-            reply_markup=reply_markup
-        )
+    await show_photo(
+        context.bot,
+        query.message,
+        "2.jpg",
+        caption="Выберите урок:",
+        reply_markup=reply_markup
+    )
 
 
 async def back_to_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -586,14 +590,13 @@ async def back_to_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     markup = generate_calendar_keyboard(offset=7)
-    await query.message.delete()
-    with open("bot/photo/1.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption="Выберите дату",
-            reply_markup=markup
-        )
+    await show_photo(
+        context.bot,
+        query.message,
+        "1.jpg",
+        caption="Выберите дату",
+        reply_markup=markup
+    )
 
 
 async def delete_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -604,7 +607,7 @@ async def delete_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     telegram_user_id = update.effective_user.id
-    delete_user_data(telegram_user_id)
+    await run_db(delete_user_data, telegram_user_id)
     context.user_data.clear()
 
     await query.message.delete()
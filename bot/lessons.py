@@ -0,0 +1,134 @@
+# bot/lessons.py
+
+
+class LessonView:
+    """
+    Урок в том виде, в каком его показывает бот (список уроков дня и карточка урока).
+    Строится и из события МЭШ (from_event), и из строки таблицы schedule (from_row),
+    так что обе ветки process_calendar_day дают одинаковые объекты.
+    Хранит только то, что нужно для показа: время — готовыми строками 'ЧЧ:ММ',
+    домашнее задание — кортежем описаний.
+    """
+
+    __slots__ = ('id', 'subject_name', 'start', 'finish', 'room_number',
+                 'lesson_theme', 'homework', 'has_cdz')
+
+    def __init__(self, id, subject_name, start, finish, room_number=None,
+                 lesson_theme=None, homework=(), has_cdz=False):
+        self.id = id
+        self.subject_name = subject_name
+        self.start = start
+        self.finish = finish
+        self.room_number = room_number
+        self.lesson_theme = lesson_theme
+        self.homework = homework
+        self.has_cdz = has_cdz
+
+    @classmethod
+    def from_event(cls, event):
+        """
+        Из элемента events.response (octodiary) или None, если у события
+        нет предмета или времени начала/конца.
+        """
+        if not (event.subject_name and event.start_at and event.finish_at):
+            return None
+        homework = ()
+        if getattr(event, 'homework', None) and event.homework.descriptions:
+            homework = tuple(event.homework.descriptions)
+        return cls(
+            event.id,
+            event.subject_name,
+            event.start_at.strftime('%H:%M'),
+            event.finish_at.strftime('%H:%M'),
+            event.room_number or None,
+            event.lesson_theme or None,
+            homework,
+            bool(getattr(event, 'materials', None)),
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Из строки load_schedule_day() или None, если нет предмета или времени.
+        """
+        lid, subj, st, et, hw_text, r_num, l_theme, has_cdz = row
+        if not (subj and st and et):
+            return None
+        homework = tuple(hw_text.split('\n')) if hw_text and hw_text.strip() else ()
+        return cls(lid, subj, st, et, r_num or None, l_theme or None, homework, bool(has_cdz))
+
+    def button_text(self) -> str:
+        return f"{self.start or '--:--'}-{self.finish or '--:--'} {self.subject_name or '---'}"
+
+    def caption(self) -> str:
+        """
+        Подпись карточки урока (время, предмет, кабинет, тема, ДЗ, отметка ЦДЗ).
+        """
+        message = (
+            f"⏰ {self.start or 'Не указано'}-{self.finish or 'Не указано'}\n"
+            f"📚 Предмет: {self.subject_name or 'Не указано'}\n"
+            f"🚪 Кабинет: {self.room_number or 'Не указан'}\n"
+            f"📖 Тема урока: {self.lesson_theme or 'Не указана'}\n"
+        )
+        if self.homework:
+            message += "📝 Домашнее задание:\n"
+            for desc in self.homework:
+                message += f"- {desc}\n"
+        else:
+            message += "📝 Домашнее задание: нет\n"
+        if self.has_cdz:
+            message += "💻 Учитель прикрепил ЦДЗ к ДЗ.\n"
+        return message
+
+
+def lessons_from_events(events):
+    """
+    Уроки из ответа get_events (только с предметом и временем начала/конца).
+    """
+    lessons = (LessonView.from_event(ev) for ev in events.response or [])
+    return [lesson for lesson in lessons if lesson is not None]
+
+
+def lessons_from_rows(rows):
+    """
+    Уроки из строк load_schedule_day() (с тем же отбором, что и для МЭШ).
+    """
+    lessons = (LessonView.from_row(row) for row in rows)
+    return [lesson for lesson in lessons if lesson is not None]
+
+
+class RenderedLesson:
+    """
+    Урок, отрисованный заранее — при записи расписания в БД (см. render_day):
+    подпись кнопки и карточка урока уже готовыми строками.
+    Подменяет LessonView там, где нужны только button_text() и caption().
+    """
+
+    __slots__ = ('id', '_button_text', '_caption')
+
+    def __init__(self, id, button_text, caption):
+        self.id = id
+        self._button_text = button_text
+        self._caption = caption
+
+    def button_text(self) -> str:
+        return self._button_text
+
+    def caption(self) -> str:
+        return self._caption
+
+
+def render_day(rows):
+    """
+    Отрисовка дня для хранения рядом с расписанием: [[id, подпись кнопки, карточка], ...]
+    в порядке показа. rows — строки schedule одного дня (как из events_to_rows).
+    """
+    lessons = lessons_from_rows(row[2:] for row in sorted(rows, key=lambda r: (r[4], r[2])))
+    return [[lesson.id, lesson.button_text(), lesson.caption()] for lesson in lessons]
+
+
+def lessons_from_render(rendered):
+    """
+    Уроки из сохранённой отрисовки дня (см. render_day).
+    """
+    return [RenderedLesson(*item) for item in rendered]
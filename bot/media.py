@@ -0,0 +1,145 @@
+# bot/media.py
+
+import logging
+import os
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+from config import settings
+from .database import run_db, load_media_file_ids, save_media_file_id, forget_media_file_id
+
+logger = logging.getLogger(__name__)
+
+PHOTO_DIR = "bot/photo"
+
+# Навигация по календарю/урокам: True — редактируем текущее сообщение,
+# False — как раньше, удаляем его и отправляем новое
+EDIT_IN_PLACE = getattr(settings, 'EDIT_IN_PLACE', True)
+
+# {имя файла: file_id} — заполняется из БД при первом обращении
+_file_ids = None
+# {имя файла: file_unique_id} — чтобы понять, какая картинка уже в сообщении
+_unique_ids = {}
+
+
+async def _get_file_ids():
+    global _file_ids
+    if _file_ids is None:
+        _file_ids = await run_db(load_media_file_ids)
+    return _file_ids
+
+
+async def remember_file_id(name: str, message):
+    """
+    Запоминает file_id картинки из отправленного сообщения (в памяти и в БД)
+    и её file_unique_id — по нему _edit_photo узнаёт картинку в сообщении.
+    Вызывается для любого отправленного фото, в том числе по file_id:
+    после перезапуска file_id берутся из media_cache, а file_unique_id
+    в памяти ещё нет.
+    """
+    if not message or not getattr(message, 'photo', None):
+        return
+    file_id = message.photo[-1].file_id
+    _unique_ids[name] = message.photo[-1].file_unique_id
+    file_ids = await _get_file_ids()
+    if file_ids.get(name) != file_id:
+        file_ids[name] = file_id
+        await run_db(save_media_file_id, name, file_id)
+
+
+async def forget_file_id(name: str):
+    """
+    Забывает file_id (Telegram его отверг) — в следующий раз файл загрузится заново.
+    """
+    file_ids = await _get_file_ids()
+    if file_ids.pop(name, None) is not None:
+        await run_db(forget_media_file_id, name)
+
+
+async def get_file_id(name: str):
+    """
+    Возвращает сохранённый file_id для bot/photo/<name> или None.
+    """
+    return (await _get_file_ids()).get(name)
+
+
+async def send_photo(bot, chat_id, name: str, **kwargs):
+    """
+    Отправляет картинку bot/photo/<name>.
+    Первый раз файл загружается с диска, и выданный Telegram file_id
+    запоминается; дальше отправляется только file_id. Если Telegram
+    отверг сохранённый file_id, файл загружается заново.
+    """
+    file_id = await get_file_id(name)
+    if file_id:
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            await remember_file_id(name, message)
+            return message
+        except BadRequest as e:
+            logger.warning("Telegram отверг file_id для %s (%s), загружаем файл заново.", name, e)
+            await forget_file_id(name)
+
+    with open(os.path.join(PHOTO_DIR, name), "rb") as f:
+        message = await bot.send_photo(chat_id=chat_id, photo=f, **kwargs)
+    await remember_file_id(name, message)
+    return message
+
+
+async def _edit_photo(bot, message, name: str, caption, reply_markup):
+    """
+    Меняет фото-сообщение на месте самым дешёвым способом:
+      - та же картинка и подпись — только клавиатура (edit_message_reply_markup),
+      - та же картинка — подпись и клавиатура (edit_message_caption),
+      - другая картинка — edit_message_media.
+    """
+    chat_id, message_id = message.chat_id, message.message_id
+    if _unique_ids.get(name) == message.photo[-1].file_unique_id:
+        if message.caption == caption:
+            return await bot.edit_message_reply_markup(
+                chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+            )
+        return await bot.edit_message_caption(
+            chat_id=chat_id, message_id=message_id, caption=caption, reply_markup=reply_markup
+        )
+
+    file_id = await get_file_id(name)
+    if file_id:
+        edited = await bot.edit_message_media(
+            media=InputMediaPhoto(file_id, caption=caption),
+            chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+        )
+        await remember_file_id(name, edited)
+        return edited
+
+    with open(os.path.join(PHOTO_DIR, name), "rb") as f:
+        edited = await bot.edit_message_media(
+            media=InputMediaPhoto(f, caption=caption),
+            chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+        )
+    await remember_file_id(name, edited)
+    return edited
+
+
+async def show_photo(bot, message, name: str, caption=None, reply_markup=None):
+    """
+    Показывает картинку bot/photo/<name> с подписью и клавиатурой вместо message.
+    Если message — фото-сообщение бота, оно редактируется на месте
+    (один вызов Bot API вместо delete + send_photo). Если отредактировать
+    нельзя (текстовое сообщение, старое сообщение, отказ Telegram) —
+    как раньше, удаляем message и отправляем новое.
+    """
+    if EDIT_IN_PLACE and message.photo:
+        try:
+            return await _edit_photo(bot, message, name, caption, reply_markup)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return message
+            logger.debug("Не удалось отредактировать сообщение (%s), отправляем заново.", e)
+
+    try:
+        await message.delete()
+    except BadRequest as e:
+        logger.debug("Не удалось удалить сообщение: %s", e)
+    return await send_photo(bot, message.chat_id, name, caption=caption, reply_markup=reply_markup)
@@ -0,0 +1,463 @@
+# bot/mesh.py
+
+import asyncio
+import copy
+import logging
+import time
+
+import aiohttp
+from octodiary.apis import AsyncMobileAPI
+from octodiary.exceptions import APIError
+from octodiary.types.mobile import EventsResponse
+from octodiary.urls import Systems
+
+from config import settings
+from .cache import LRUCache
+from .database import (
+    run_db,
+    load_identity,
+    save_identity,
+    invalidate_identity,
+    mark_token_used,
+)
+
+logger = logging.getLogger(__name__)
+
+# Общий пул HTTP-соединений к МЭШ. Лимиты — на весь бот: в многопроцессном
+# режиме (SHARDS > 1) у каждого рабочего процесса своя сессия с долей 1/SHARDS
+# (см. set_shards)
+MESH_HTTP_POOL_SIZE = getattr(settings, 'MESH_HTTP_POOL_SIZE', 100)
+MESH_HTTP_POOL_PER_HOST = getattr(settings, 'MESH_HTTP_POOL_PER_HOST', 50)
+MESH_HTTP_TIMEOUT = getattr(settings, 'MESH_HTTP_TIMEOUT', 20)
+
+# Сколько секунд доверяем кэшу profile/family/child (по умолчанию сутки)
+IDENTITY_TTL = getattr(settings, 'IDENTITY_TTL', 24 * 3600)
+
+# Коды ответа МЭШ, после которых кэш идентичности считаем недействительным
+AUTH_ERROR_CODES = (401, 403)
+
+# Circuit breaker: после MESH_BREAKER_FAILURES отказов подряд (ошибка сети,
+# таймаут, 5xx или ответ дольше MESH_BREAKER_SLOW_CALL секунд) запросы к МЭШ
+# не отправляются MESH_BREAKER_COOLDOWN секунд; затем один пробный запрос.
+# Если и он неудачен, пауза удваивается (не больше MESH_BREAKER_MAX_COOLDOWN).
+# Предохранитель свой в каждом процессе: при SHARDS > 1 рабочий процесс
+# считает отказы подряд только среди своих запросов и открывается сам по себе.
+MESH_BREAKER_FAILURES = getattr(settings, 'MESH_BREAKER_FAILURES', 5)
+MESH_BREAKER_SLOW_CALL = getattr(settings, 'MESH_BREAKER_SLOW_CALL', 10)
+MESH_BREAKER_COOLDOWN = getattr(settings, 'MESH_BREAKER_COOLDOWN', 30)
+MESH_BREAKER_MAX_COOLDOWN = getattr(settings, 'MESH_BREAKER_MAX_COOLDOWN', 600)
+
+# Успешное использование токена пишем в token_state не чаще раза в столько секунд
+TOKEN_OK_WRITE_INTERVAL = 300
+# Кому успех уже записан за последние TOKEN_OK_WRITE_INTERVAL секунд
+# (ограничено: вытесненный пользователь просто запишется лишний раз)
+_token_ok_written = LRUCache(10000, TOKEN_OK_WRITE_INTERVAL)
+
+
+# Запросы get_events, которые сейчас выполняются: {(tg_id, begin_date, end_date): Task}.
+# Одновременные вызовы за тот же период (или вложенный в него) ждут один запрос.
+_inflight = {}
+# Сколько вызовов get_user_events обошлись без своего запроса к МЭШ (с запуска процесса)
+coalesced_requests = 0
+
+# {event loop: aiohttp.ClientSession} — сессия привязана к своему loop
+_sessions = {}
+# (limit, limit_per_host) пула этого процесса
+_http_limits = (MESH_HTTP_POOL_SIZE, MESH_HTTP_POOL_PER_HOST)
+
+
+def set_shards(shards: int):
+    """
+    Процесс обслуживает 1/shards пользователей — и получает такую же долю
+    лимитов HTTP-пула к МЭШ. Вызывается до первого запроса.
+    """
+    global _http_limits
+    _http_limits = (max(1, MESH_HTTP_POOL_SIZE // shards), max(1, MESH_HTTP_POOL_PER_HOST // shards))
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую keep-alive сессию к МЭШ для текущего event loop
+    (создаёт при первом обращении). Куки не хранятся: токен передаётся
+    заголовками, а общий cookie jar смешал бы куки разных пользователей.
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=_http_limits[0],
+            limit_per_host=_http_limits[1],
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(total=MESH_HTTP_TIMEOUT),
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_http_session(*args):
+    """
+    Закрывает общую сессию текущего event loop.
+    Подходит как post_shutdown-хук Application (аргумент application игнорируется).
+    """
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+class PooledMobileAPI(AsyncMobileAPI):
+    """
+    AsyncMobileAPI, который ходит в МЭШ через общую сессию get_http_session(),
+    а не открывает новое TCP+TLS-соединение на каждый запрос.
+    Вход по логину/паролю (login, esia_*) работает как в octodiary.
+    Для моделей из raw_models вместо разобранного объекта возвращается
+    сырой JSON — его разбирают в пуле процессов (см. bot/offload.py).
+    """
+
+    raw_models = frozenset()
+
+    async def request(
+            self, method: str,
+            base_url: str, path: str,
+            custom_headers=None,
+            model=None,
+            is_list: bool = False,
+            return_json: bool = False,
+            return_raw_text: bool = False,
+            required_token: bool = True,
+            return_raw_response: bool = False,
+            **kwargs
+    ):
+        params = kwargs.pop("params", {})
+        async with get_http_session().request(
+                method=method,
+                url=self.init_params(base_url + path, params),
+                headers=self.headers(required_token, custom_headers),
+                **kwargs
+        ) as response:
+            await self._check_response(response)
+            raw_text = await response.text()
+
+            if not raw_text:
+                return None
+            if return_raw_response:
+                return response
+            if return_json:
+                return await response.json()
+            if return_raw_text:
+                return raw_text
+            if is_list:
+                return self.parse_list_models(model, raw_text)
+            if model in self.raw_models:
+                return raw_text
+            if model:
+                return model.model_validate_json(raw_text)
+            return raw_text
+
+
+def create_api(token=None, raw_events: bool = False) -> PooledMobileAPI:
+    """
+    Создаёт API-клиент МЭШ пользователя поверх общего пула соединений.
+    raw_events=True — get_events возвращает сырой JSON (str), а не EventsResponse.
+    """
+    api = PooledMobileAPI(system=Systems.MES)
+    if token is not None:
+        api.token = token
+    if raw_events:
+        api.raw_models = frozenset((EventsResponse,))
+    return api
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для запросов к МЭШ.
+      closed    — запросы идут, считаются отказы подряд;
+      open      — запросы не отправляются до конца паузы;
+      half_open — пауза прошла, пропускается один пробный запрос:
+                  успех закрывает предохранитель, отказ снова открывает.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failures: int, slow_call: float, cooldown: float, max_cooldown: float):
+        self.threshold = failures
+        self.slow_call = slow_call
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _cooled_down(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.cooldown
+
+    def is_open(self) -> bool:
+        """
+        True, если сейчас запрос к МЭШ не будет отправлен
+        (открыт и пауза не прошла, или уже идёт пробный запрос).
+        """
+        if self.state == self.OPEN:
+            return not self._cooled_down()
+        return self.state == self.HALF_OPEN and self.probing
+
+    def allow(self):
+        """
+        Можно ли отправить запрос. В half_open пропускает только один (пробный).
+        Возвращает состояние, в котором запрос пропущен (его нужно передать
+        в record() / release()), или None, если отправлять нельзя.
+        """
+        if self.state == self.OPEN and self._cooled_down():
+            self.state = self.HALF_OPEN
+            self.probing = False
+            logger.info("МЭШ: пауза предохранителя прошла, пробный запрос.")
+        if self.state == self.CLOSED:
+            return self.CLOSED
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return self.HALF_OPEN
+        return None
+
+    def record(self, admitted: str, ok: bool, elapsed: float = 0.0):
+        """
+        Учитывает результат запроса, пропущенного allow() в состоянии admitted.
+        Слишком медленный ответ считается отказом. Ответы на запросы, отправленные
+        до смены состояния (например, успех, пришедший уже после открытия),
+        не учитываются: в open и half_open решает только пробный запрос.
+        """
+        if admitted != self.state:
+            return
+        if ok and elapsed < self.slow_call:
+            if self.state != self.CLOSED:
+                logger.info("МЭШ снова отвечает, предохранитель закрыт.")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.base_cooldown
+            return
+
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self._open()
+        elif self.failures >= self.threshold:
+            self._open()
+
+    def release(self, admitted: str):
+        """
+        Запрос отменён, не дождавшись ответа: если он был пробным,
+        пробный можно отправить заново.
+        """
+        if admitted == self.HALF_OPEN and self.state == self.HALF_OPEN:
+            self.probing = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.probing = False
+        logger.warning("МЭШ: %s отказов подряд, запросы приостановлены на %ss.",
+                       self.failures, self.cooldown)
+
+
+breaker = CircuitBreaker(
+    MESH_BREAKER_FAILURES, MESH_BREAKER_SLOW_CALL, MESH_BREAKER_COOLDOWN, MESH_BREAKER_MAX_COOLDOWN
+)
+
+
+class MeshUnavailableError(Exception):
+    """
+    МЭШ недоступен (предохранитель открыт) — запрос не отправлялся.
+    """
+
+
+class NoIdentityError(Exception):
+    """
+    У пользователя нет профилей или детей в МЭШ — запрашивать расписание не для кого.
+    """
+
+
+def is_auth_error(error: Exception) -> bool:
+    return isinstance(error, APIError) and error.status_code in AUTH_ERROR_CODES
+
+
+def is_outage(error: Exception) -> bool:
+    """
+    Ошибка говорит о недоступности МЭШ (сеть, таймаут, 5xx),
+    а не о проблеме конкретного пользователя.
+    """
+    if isinstance(error, APIError):
+        return not error.status_code or error.status_code >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError, OSError))
+
+
+async def note_token_result(tg_id: int, ok: bool):
+    """
+    Запоминает в token_state, что токен пользователя сработал (ok=True)
+    или был отвергнут МЭШ (ok=False). Успехи пишутся с прореживанием.
+    """
+    now = time.time()
+    if ok:
+        if _token_ok_written.get(tg_id):
+            return
+        _token_ok_written.put(tg_id, True)
+    else:
+        _token_ok_written.invalidate(tg_id)
+    await run_db(mark_token_used, tg_id, ok, now)
+
+
+async def _acquire(limiter):
+    if limiter is not None:
+        await limiter.acquire()
+
+
+async def resolve_identity(api, tg_id: int, limiter=None, force: bool = False):
+    """
+    Возвращает (person_guid, mes_role) для пользователя tg_id.
+    Берёт значения из таблицы user_identity, если они моложе IDENTITY_TTL,
+    иначе заново спрашивает get_users_profile_info + get_family_profile
+    и сохраняет результат.
+    """
+    if not force:
+        row = await run_db(load_identity, tg_id)
+        if row and row[3] and time.time() - row[3] < IDENTITY_TTL:
+            return row[1], row[2]
+
+    await _acquire(limiter)
+    profiles = await api.get_users_profile_info()
+    if not profiles:
+        raise NoIdentityError(f"Нет профилей у {tg_id}")
+    profile_id = profiles[0].id
+
+    await _acquire(limiter)
+    family = await api.get_family_profile(profile_id=profile_id)
+    if not family.children:
+        raise NoIdentityError(f"У пользователя {tg_id} нет children")
+
+    person_guid = family.children[0].contingent_guid
+    mes_role = family.profile.type
+    await run_db(save_identity, tg_id, profile_id, person_guid, mes_role)
+    return person_guid, mes_role
+
+
+def _slice_events(events, begin_date, end_date):
+    """
+    Ответ get_events, в котором оставлены только события за [begin_date, end_date].
+    """
+    items = [
+        ev for ev in events.response or []
+        if ev.start_at and begin_date <= ev.start_at.date() <= end_date
+    ]
+    if hasattr(events, 'model_copy'):
+        return events.model_copy(update={'response': items})
+    sliced = copy.copy(events)
+    sliced.response = items
+    return sliced
+
+
+def _find_inflight(tg_id: int, begin_date, end_date):
+    """
+    Возвращает (task, точное совпадение) для выполняющегося запроса
+    пользователя, период которого покрывает [begin_date, end_date], или (None, False).
+    """
+    task = _inflight.get((tg_id, begin_date, end_date))
+    if task is not None:
+        return task, True
+    for (uid, begin, end), task in _inflight.items():
+        if uid == tg_id and begin <= begin_date and end_date <= end:
+            return task, False
+    return None, False
+
+
+async def get_user_events(api, tg_id: int, begin_date, end_date, limiter=None):
+    """
+    Запрашивает события МЭШ пользователя за период [begin_date, end_date].
+    Если такой же запрос (или запрос за более широкий период) уже выполняется,
+    ждёт его результат вместо нового обращения к МЭШ (single-flight).
+    Отмена одного из ожидающих не отменяет общий запрос.
+    Результат — EventsResponse или, если api создан с raw_events=True, сырой JSON;
+    клиент без raw_events, присоединившийся к такому запросу, получает разобранный ответ.
+    """
+    global coalesced_requests
+    task, exact = _find_inflight(tg_id, begin_date, end_date)
+    if task is not None:
+        coalesced_requests += 1
+        events = await asyncio.shield(task)
+        if isinstance(events, str) and (not exact or EventsResponse not in api.raw_models):
+            events = EventsResponse.model_validate_json(events)
+        return events if exact else _slice_events(events, begin_date, end_date)
+
+    key = (tg_id, begin_date, end_date)
+    task = asyncio.ensure_future(_fetch_user_events(api, tg_id, begin_date, end_date, limiter))
+    _inflight[key] = task
+
+    def _done(t):
+        if _inflight.get(key) is t:
+            del _inflight[key]
+        if not t.cancelled():
+            t.exception()  # исключение забирают ожидающие; если все они отменены — не ругаемся в лог
+
+    task.add_done_callback(_done)
+    return await asyncio.shield(task)
+
+
+async def call_mesh(request):
+    """
+    Выполняет запрос к МЭШ request() (корутинная функция без аргументов)
+    через предохранитель breaker: пока он открыт — сразу MeshUnavailableError,
+    иначе результат (успех, отказ, задержка) учитывается предохранителем.
+    """
+    admitted = breaker.allow()
+    if not admitted:
+        raise MeshUnavailableError("МЭШ недоступен, запрос не отправлен")
+    started = time.monotonic()
+    try:
+        result = await request()
+    except asyncio.CancelledError:
+        breaker.release(admitted)
+        raise
+    except Exception as e:
+        breaker.record(admitted, not is_outage(e), time.monotonic() - started)
+        raise
+    breaker.record(admitted, True, time.monotonic() - started)
+    return result
+
+
+async def _fetch_user_events(api, tg_id: int, begin_date, end_date, limiter=None):
+    """
+    Сам запрос к МЭШ: при кэше идентичности это один запрос вместо трёх.
+    Идёт через предохранитель breaker: пока он открыт, сразу MeshUnavailableError.
+    Результат (успех / ошибка авторизации) отмечается в token_state.
+    На ошибке авторизации кэш сбрасывается, и исключение пробрасывается дальше.
+    """
+    admitted = breaker.allow()
+    if not admitted:
+        raise MeshUnavailableError("МЭШ недоступен, запрос не отправлен")
+    started = time.monotonic()
+    try:
+        person_guid, mes_role = await resolve_identity(api, tg_id, limiter)
+        await _acquire(limiter)
+        started = time.monotonic()  # ожидание в limiter в задержку МЭШ не входит
+        events = await api.get_events(
+            person_id=person_guid,
+            mes_role=mes_role,
+            begin_date=begin_date,
+            end_date=end_date
+        )
+    except asyncio.CancelledError:
+        breaker.release(admitted)
+        raise
+    except Exception as e:
+        breaker.record(admitted, not is_outage(e), time.monotonic() - started)
+        if is_auth_error(e):
+            logger.info("Ошибка авторизации МЭШ для %s, сбрасываем кэш идентичности.", tg_id)
+            await run_db(invalidate_identity, tg_id)
+            await note_token_result(tg_id, False)
+        raise
+    breaker.record(admitted, True, time.monotonic() - started)
+    await note_token_result(tg_id, True)
+    return events
@@ -0,0 +1,184 @@
+# bot/offload.py
+
+import asyncio
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cryptography.fernet import Fernet
+from octodiary.types.mobile import EventsResponse
+
+from config import settings
+from config.settings import ENCRYPTION_KEY_PATH
+from .database import events_to_rows
+
+logger = logging.getLogger(__name__)
+
+# Пул процессов для CPU-работы фонового обновления: расшифровка токенов
+# и разбор ответов get_events в строки schedule. 0 — всё в основном процессе.
+# В многопроцессном режиме (SHARDS > 1) у каждого рабочего процесса свой пул.
+REFRESH_POOL_SIZE = getattr(settings, 'REFRESH_POOL_SIZE', 0)
+# Сколько токенов / ответов МЭШ уходит в пул одним заданием
+REFRESH_DECRYPT_BATCH = getattr(settings, 'REFRESH_DECRYPT_BATCH', 200)
+REFRESH_PARSE_BATCH = getattr(settings, 'REFRESH_PARSE_BATCH', 20)
+# Сколько секунд неполная пачка ждёт добора перед отправкой в пул
+REFRESH_POOL_LINGER = getattr(settings, 'REFRESH_POOL_LINGER', 0.05)
+
+_pool = None
+
+# Fernet в процессе пула (см. _init_worker)
+_cipher = None
+
+
+def _init_worker(key_path: str):
+    global _cipher
+    with open(key_path, 'rb') as f:
+        _cipher = Fernet(f.read())
+
+
+def decrypt_tokens(encrypted_tokens):
+    """
+    Выполняется в процессе пула: [encrypted_token, ...] -> [(token_data, error), ...].
+    """
+    results = []
+    for encrypted_token in encrypted_tokens:
+        try:
+            results.append((json.loads(_cipher.decrypt(encrypted_token).decode()), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def parse_events_rows(items):
+    """
+    Выполняется в процессе пула: [(user_id, raw_json), ...] -> [(rows, error), ...],
+    rows — готовые к записи строки schedule (см. events_to_rows).
+    """
+    results = []
+    for user_id, raw in items:
+        try:
+            results.append((events_to_rows(user_id, EventsResponse.model_validate_json(raw)), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """
+    Общий пул процессов (создаётся при первом обращении).
+    Процессы запускаются через spawn: форк процесса с работающим loop,
+    потоками пула БД и открытыми соединениями небезопасен.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=REFRESH_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(ENCRYPTION_KEY_PATH,),
+        )
+        logger.info("Пул обработки обновлений: %s процессов.", REFRESH_POOL_SIZE)
+    return _pool
+
+
+def shutdown_pool(wait: bool = True):
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+class PoolBatcher:
+    """
+    Собирает отдельные элементы в пачки и отправляет их в пул процессов
+    одним заданием func(items) -> [(result, error), ...]: пачка уходит,
+    когда набралось batch_size элементов или прошло linger секунд
+    с первого из них. submit() возвращает результат своего элемента.
+    """
+
+    def __init__(self, func, batch_size: int, linger: float = REFRESH_POOL_LINGER):
+        self.func = func
+        self.batch_size = batch_size
+        self.linger = linger
+        self.batches = 0
+        self._items = []
+        self._waiters = []
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._items.append(item)
+        self._waiters.append(waiter)
+        if len(self._items) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self._flush)
+        result, error = await waiter
+        if error is not None:
+            raise RuntimeError(error)
+        return result
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        waiters, self._waiters = self._waiters, []
+        if not items:
+            return
+        self.batches += 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(get_pool(), self.func, items)
+        except Exception as e:
+            logger.error("Не удалось отправить пачку из %s элементов в пул: %s", len(items), e)
+            self._fail(e, waiters)
+            return
+        future.add_done_callback(lambda f: self._resolve(f, waiters))
+
+    @staticmethod
+    def _fail(error, waiters):
+        if isinstance(error, BrokenProcessPool):
+            # процесс пула упал — следующая пачка создаст пул заново
+            shutdown_pool(wait=False)
+        PoolBatcher._set_results(waiters, [(None, repr(error))] * len(waiters))
+
+    @staticmethod
+    def _resolve(future, waiters):
+        if future.cancelled():
+            PoolBatcher._set_results(waiters, [(None, "задание пула отменено")] * len(waiters))
+        elif future.exception() is not None:
+            PoolBatcher._fail(future.exception(), waiters)
+        else:
+            PoolBatcher._set_results(waiters, future.result())
+
+    @staticmethod
+    def _set_results(waiters, results):
+        for waiter, result in zip(waiters, results):
+            if not waiter.done():
+                waiter.set_result(result)
+
+
+class SweepOffload:
+    """
+    CPU-этапы одного прохода обновления, вынесенные в пул процессов:
+      decrypt(encrypted_token) — расшифровка токена (пачками по decrypt_batch),
+      rows(user_id, raw_json)  — разбор ответа get_events и сборка строк
+                                 schedule (пачками по parse_batch).
+    """
+
+    def __init__(self, decrypt_batch: int = REFRESH_DECRYPT_BATCH,
+                 parse_batch: int = REFRESH_PARSE_BATCH):
+        self._decrypt = PoolBatcher(decrypt_tokens, decrypt_batch)
+        self._parse = PoolBatcher(parse_events_rows, parse_batch)
+
+    async def decrypt(self, encrypted_token):
+        return await self._decrypt.submit(encrypted_token)
+
+    async def rows(self, user_id: int, raw: str):
+        return await self._parse.submit((user_id, raw))
+
+    def stats(self) -> dict:
+        return {'decrypt_batches': self._decrypt.batches, 'parse_batches': self._parse.batches}
@@ -0,0 +1,174 @@
+# bot/persistence.py
+
+import asyncio
+import copy
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import settings
+from .database import (
+    run_db,
+    load_user_data_rows,
+    load_conversation_rows,
+    save_persistence_batch,
+)
+
+logger = logging.getLogger(__name__)
+
+# Раз в столько секунд Application отдаёт изменённые user_data и состояния разговоров
+PERSISTENCE_UPDATE_INTERVAL = getattr(settings, 'PERSISTENCE_UPDATE_INTERVAL', 30)
+# Сколько секунд копим изменения одного прохода перед записью одной транзакцией
+PERSISTENCE_WRITE_DELAY = getattr(settings, 'PERSISTENCE_WRITE_DELAY', 1)
+
+
+class UserData(dict):
+    """
+    context.user_data (см. ContextTypes(user_data=UserData)).
+    Живые объекты — API-клиент, объект ввода SMS-кода, уроки — а также логин
+    и пароль mos.ru остаются только в памяти: при копировании для persistence они отбрасываются.
+    Уроки сохраняются ссылками (lessons_date + lesson_ids) и после
+    перезапуска восстанавливаются из таблицы schedule.
+    """
+
+    TRANSIENT_KEYS = frozenset(('api', 'sms_code_obj', 'lessons', 'username', 'password'))
+
+    def __deepcopy__(self, memo):
+        return {
+            key: copy.deepcopy(value, memo)
+            for key, value in self.items()
+            if key not in self.TRANSIENT_KEYS
+        }
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence для user_data и состояний ConversationHandler в той же SQLite,
+    что и остальные данные бота (таблицы user_data и conversations).
+    Данные хранятся в JSON. Изменения одного прохода update_persistence
+    копятся и пишутся одной транзакцией через PERSISTENCE_WRITE_DELAY секунд;
+    flush() при остановке дописывает всё накопленное.
+    В многопроцессном режиме (bot/shard.py) каждый процесс загружает только
+    своих пользователей: telegram_user_id % shards == shard.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL,
+                 write_delay: float = PERSISTENCE_WRITE_DELAY,
+                 shard: int = 0, shards: int = 1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.write_delay = write_delay
+        self.shard = shard
+        self.shards = shards
+        self._users = {}          # {user_id: data_json или None (удалить)}
+        self._conversations = {}  # {(name, key_json): state_json или None (удалить)}
+        self._write_task = None
+
+    async def get_user_data(self):
+        rows = await run_db(load_user_data_rows, self.shard, self.shards)
+        user_data = {}
+        for user_id, data in rows:
+            try:
+                user_data[user_id] = UserData(json.loads(data))
+            except ValueError as e:
+                logger.warning("Не удалось прочитать user_data пользователя %s: %s", user_id, e)
+        return user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        rows = await run_db(load_conversation_rows, name)
+        conversations = {}
+        for key, state in rows:
+            key = tuple(json.loads(key))
+            # ключ разговора — (chat_id, user_id): берём только своих пользователей
+            if key[-1] % self.shards == self.shard:
+                conversations[key] = json.loads(state)
+        return conversations
+
+    async def update_conversation(self, name: str, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data):
+        if not data:
+            self._users[user_id] = None
+        else:
+            try:
+                self._users[user_id] = json.dumps(data, ensure_ascii=False)
+            except TypeError as e:
+                logger.error("user_data пользователя %s не сериализуется в JSON: %s", user_id, e)
+                return
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int):
+        self._users[user_id] = None
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._delayed_write())
+
+    async def _delayed_write(self):
+        await asyncio.sleep(self.write_delay)
+        await self._write()
+
+    async def _write(self):
+        users, self._users = self._users, {}
+        conversations, self._conversations = self._conversations, {}
+        if not users and not conversations:
+            return
+        try:
+            await run_db(
+                save_persistence_batch,
+                [(uid, data) for uid, data in users.items() if data is not None],
+                [(uid,) for uid, data in users.items() if data is None],
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None],
+                [(name, key) for (name, key), state in conversations.items() if state is None],
+            )
+        except Exception as e:
+            logger.error("Ошибка записи persistence (%s пользователей, %s разговоров): %s",
+                         len(users), len(conversations), e)
+            # Вернём несохранённое, не затирая более свежие изменения
+            for uid, data in users.items():
+                self._users.setdefault(uid, data)
+            for key, state in conversations.items():
+                self._conversations.setdefault(key, state)
+
+    async def flush(self):
+        task = self._write_task
+        if task is not None and not task.done():
+            await asyncio.gather(task, return_exceptions=True)
+        await self._write()
@@ -0,0 +1,517 @@
+# bot/refresher.py
+
+import asyncio
+import logging
+import random
+import time
+from datetime import date, timedelta
+
+from config import settings
+from .auth import decrypt_token_cached
+from .cache import LRUCache, token_cache
+from .database import (
+    run_db,
+    list_due_users,
+    touch_user_activity,
+    save_refresh_results,
+    events_to_rows,
+    store_user_schedule,
+    store_user_schedules,
+    load_fetch_times,
+)
+from . import mesh
+from .offload import REFRESH_POOL_SIZE, SweepOffload
+from .mesh import create_api, get_user_events, is_auth_error, NoIdentityError, MeshUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Параметры фонового обновления (можно переопределить в config/settings.py).
+# REFRESH_CONCURRENCY и MESH_RATE_LIMIT — на весь бот: при SHARDS > 1 каждый
+# рабочий процесс получает 1/SHARDS (см. _run_refresh_tick)
+REFRESH_CONCURRENCY = getattr(settings, 'REFRESH_CONCURRENCY', 20)
+REFRESH_USER_TIMEOUT = getattr(settings, 'REFRESH_USER_TIMEOUT', 30)
+MESH_RATE_LIMIT = getattr(settings, 'MESH_RATE_LIMIT', 30)  # запросов в секунду
+REFRESH_WRITE_BATCH = getattr(settings, 'REFRESH_WRITE_BATCH', 100)  # пользователей на транзакцию
+REFRESH_WINDOW_DAYS = 10
+# Уроки старше стольких дней удаляются (календарь показывает до 13 дней назад)
+SCHEDULE_RETENTION_DAYS = 14
+
+# План инкрементального обновления: через сколько секунд день пора перезагрузить.
+# Сегодня и ближайшие SYNC_HOT_DAYS-1 дней — каждый проход, дальнее будущее —
+# реже, прошедшие дни — редко.
+SYNC_HOT_DAYS = getattr(settings, 'SYNC_HOT_DAYS', 3)
+SYNC_HOT_TTL = getattr(settings, 'SYNC_HOT_TTL', 50 * 60)
+SYNC_FUTURE_TTL = getattr(settings, 'SYNC_FUTURE_TTL', 6 * 3600)
+SYNC_PAST_TTL = getattr(settings, 'SYNC_PAST_TTL', 24 * 3600)
+
+# Планировщик: пользователи разбиты на REFRESH_BUCKETS корзин
+# (telegram_user_id % REFRESH_BUCKETS), за REFRESH_INTERVAL секунд
+# по очереди обходятся все корзины — по одной за тик.
+REFRESH_INTERVAL = getattr(settings, 'REFRESH_INTERVAL', 3600)
+REFRESH_BUCKETS = getattr(settings, 'REFRESH_BUCKETS', 60)
+REFRESH_TICK = REFRESH_INTERVAL / REFRESH_BUCKETS
+# Доля тика, по которой равномерно (с джиттером) разносятся старты пользователей
+REFRESH_SPREAD = getattr(settings, 'REFRESH_SPREAD', 0.8)
+# Кто не заходил в бота дольше REFRESH_ACTIVE_WINDOW секунд,
+# обновляется только раз в REFRESH_INACTIVE_EVERY циклов
+REFRESH_ACTIVE_WINDOW = getattr(settings, 'REFRESH_ACTIVE_WINDOW', 7 * 24 * 3600)
+REFRESH_INACTIVE_EVERY = getattr(settings, 'REFRESH_INACTIVE_EVERY', 6)
+# Экспоненциальная отсрочка для токенов, которые МЭШ отвергает
+REFRESH_BACKOFF_BASE = getattr(settings, 'REFRESH_BACKOFF_BASE', REFRESH_INTERVAL)
+REFRESH_BACKOFF_MAX = getattr(settings, 'REFRESH_BACKOFF_MAX', 7 * 24 * 3600)
+
+# Сколько секунд при остановке бота ждём, пока текущий проход доработает
+REFRESH_STOP_TIMEOUT = getattr(settings, 'REFRESH_STOP_TIMEOUT', REFRESH_USER_TIMEOUT + 5)
+
+# Текущий проход планировщика (задача в loop бота) и флаг остановки
+_refresh_task = None
+_stopping = asyncio.Event()
+
+# Активность пользователя пишем в БД не чаще раза в столько секунд
+ACTIVITY_WRITE_INTERVAL = 600
+# Чья активность уже записана за последние ACTIVITY_WRITE_INTERVAL секунд
+# (ограничено: вытесненный пользователь просто запишется лишний раз)
+_activity_written = LRUCache(10000, ACTIVITY_WRITE_INTERVAL)
+
+
+class RateLimiter:
+    """
+    Простой token bucket: не больше `rate` запросов в секунду
+    (с допустимым всплеском `burst`) на все корутины сразу.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RefreshStats:
+    """
+    Статистика одного прохода: сколько пользователей обновлено,
+    пропущено, с ошибкой, и задержки по каждому пользователю.
+    Время прохода и пропускная способность считаются с начала работы
+    первого воркера; растяжка стартов (spread) выводится отдельно.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_started = None
+        self.last_started = None
+        self.finished = None
+        self.latencies = []
+        self.ok = 0
+        self.skipped = 0
+        self.failed = 0
+        self.write_failed = 0
+        self.commits = 0
+        self.fresh = 0
+        self.unavailable = 0
+        self.changed_days = 0
+
+    def add(self, status: str, latency: float):
+        self.latencies.append(latency)
+        if status == 'ok':
+            self.ok += 1
+        elif status == 'skipped':
+            self.skipped += 1
+        else:
+            self.failed += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        values = sorted(self.latencies)
+        idx = min(len(values) - 1, max(0, round(q * len(values)) - 1))
+        return values[idx]
+
+    def worker_started(self):
+        now = time.monotonic()
+        if self.first_started is None:
+            self.first_started = now
+        self.last_started = now
+
+    @property
+    def spread(self) -> float:
+        if self.first_started is None:
+            return 0.0
+        return self.last_started - self.first_started
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - (self.first_started or self.started)
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"users={len(self.latencies)} ok={self.ok} skipped={self.skipped} failed={self.failed} "
+            f"fresh={self.fresh} unavailable={self.unavailable} write_failed={self.write_failed} "
+            f"commits={self.commits} changed_days={self.changed_days} "
+            f"elapsed={self.elapsed:.1f}s spread={self.spread:.1f}s throughput={self.throughput:.2f} users/s "
+            f"p50={self.percentile(0.50):.2f}s p95={self.percentile(0.95):.2f}s"
+        )
+
+
+async def user_token(tg_id: int, enc_token, offload: SweepOffload = None):
+    """
+    Расшифрованный токен пользователя: из token_cache, иначе расшифровка —
+    в этом процессе или, если передан offload, пачкой в пуле процессов.
+    """
+    if offload is None:
+        return decrypt_token_cached(tg_id, enc_token)
+    token_data = token_cache.get(tg_id)
+    if token_data is None:
+        token_data = await offload.decrypt(enc_token)
+        token_cache.put(tg_id, token_data)
+    return token_data
+
+
+async def fetch_user_events(tg_id: int, enc_token, limiter: RateLimiter, begin_date: date, end_date: date,
+                            offload: SweepOffload = None):
+    """
+    Загружает события МЭШ на окно [begin_date, end_date] для одного пользователя.
+    Каждый запрос к МЭШ проходит через общий limiter.
+    С offload ответ не разбирается здесь: возвращается сырой JSON (см. create_api).
+    """
+    mesh_api = create_api(await user_token(tg_id, enc_token, offload), raw_events=offload is not None)
+
+    try:
+        return await get_user_events(mesh_api, tg_id, begin_date, end_date, limiter)
+    except NoIdentityError as e:
+        logger.warning("%s. Пропускаем.", e)
+        return None
+
+
+def refresh_window():
+    today = date.today()
+    return today - timedelta(days=REFRESH_WINDOW_DAYS), today + timedelta(days=REFRESH_WINDOW_DAYS)
+
+
+def day_ttl(day: date, today: date) -> float:
+    if day < today:
+        return SYNC_PAST_TTL
+    if (day - today).days < SYNC_HOT_DAYS:
+        return SYNC_HOT_TTL
+    return SYNC_FUTURE_TTL
+
+
+def plan_fetch(fetch_times: dict, begin_date: date, end_date: date, now: float = None):
+    """
+    Решает, какие дни окна [begin_date, end_date] пора перезагрузить из МЭШ.
+    fetch_times — {date: fetched_at} пользователя (см. load_fetch_times).
+    Возвращает (first, last) — наименьший отрезок, покрывающий все такие дни
+    (get_events всё равно берёт диапазон), или None, если всё свежее.
+    """
+    now = now or time.time()
+    today = date.today()
+    due = []
+    for i in range((end_date - begin_date).days + 1):
+        day = begin_date + timedelta(days=i)
+        fetched_at = fetch_times.get(day.strftime('%Y-%m-%d'))
+        if fetched_at is None or now - fetched_at >= day_ttl(day, today):
+            due.append(day)
+    if not due:
+        return None
+    return due[0], due[-1]
+
+
+async def refresh_user_days(api, tg_id: int, begin_date: date, end_date: date, limiter=None):
+    """
+    Перезагружает из МЭШ расписание пользователя только за [begin_date, end_date]:
+    заменяет уроки этого периода в schedule и отмечает дни свежими.
+    Возвращает ответ get_events.
+    """
+    events = await get_user_events(api, tg_id, begin_date, end_date, limiter)
+    await run_db(store_user_schedule, tg_id, events, begin_date, end_date)
+    return events
+
+
+async def refresh_user(tg_id: int, enc_token, limiter: RateLimiter, timeout: float,
+                       begin_date: date, end_date: date, offload: SweepOffload = None):
+    """
+    Загружает расписание одного пользователя.
+    Возвращает (status, rows): status — 'ok', 'skipped', 'failed',
+    'auth' (МЭШ отверг токен) или 'unavailable' (предохранитель МЭШ открыт),
+    rows — готовые к записи строки schedule (только для 'ok').
+    С offload расшифровка токена и разбор ответа идут в пуле процессов.
+    """
+    try:
+        events = await asyncio.wait_for(
+            fetch_user_events(tg_id, enc_token, limiter, begin_date, end_date, offload), timeout
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Таймаут (%ss) при обновлении расписания user_id=%s.", timeout, tg_id)
+        return 'failed', None
+    except MeshUnavailableError:
+        return 'unavailable', None
+    except Exception as e:
+        logger.warning("Ошибка при обновлении расписания user_id=%s: %s", tg_id, e)
+        return ('auth' if is_auth_error(e) else 'failed'), None
+
+    if not events:
+        return 'skipped', None
+
+    if isinstance(events, str):
+        try:
+            return 'ok', await offload.rows(tg_id, events)
+        except Exception as e:
+            logger.warning("Не удалось разобрать ответ МЭШ для user_id=%s: %s", tg_id, e)
+            return 'failed', None
+    return 'ok', events_to_rows(tg_id, events)
+
+
+def purge_date() -> date:
+    return date.today() - timedelta(days=SCHEDULE_RETENTION_DAYS)
+
+
+async def note_activity(tg_id: int):
+    """
+    Запоминает, что пользователь пользуется ботом: такие пользователи
+    обновляются каждый цикл и первыми в своей корзине.
+    Пишется в БД с прореживанием.
+    """
+    if _activity_written.get(tg_id):
+        return
+    now = time.time()
+    _activity_written.put(tg_id, True)
+    await run_db(touch_user_activity, tg_id, now)
+
+
+def backoff_delay(failures: int) -> float:
+    """
+    Отсрочка (секунды) после failures подряд отвергнутых попыток:
+    REFRESH_BACKOFF_BASE * 2^(failures-1), не больше REFRESH_BACKOFF_MAX, ±10%.
+    """
+    delay = min(REFRESH_BACKOFF_MAX, REFRESH_BACKOFF_BASE * 2 ** (failures - 1))
+    return delay * random.uniform(0.9, 1.1)
+
+
+def current_bucket(now: float = None):
+    """
+    Возвращает (bucket, cycle): корзину текущего тика и номер цикла.
+    """
+    now = now or time.time()
+    return int(now // REFRESH_TICK) % REFRESH_BUCKETS, int(now // REFRESH_INTERVAL)
+
+
+def is_due(tg_id: int, last_active_at, cycle: int, now: float = None) -> bool:
+    """
+    Активные пользователи обновляются каждый цикл, остальные — раз
+    в REFRESH_INACTIVE_EVERY циклов (каждый в свой, чтобы не скапливались).
+    """
+    now = now or time.time()
+    if last_active_at and now - last_active_at < REFRESH_ACTIVE_WINDOW:
+        return True
+    return (cycle + tg_id // REFRESH_BUCKETS) % REFRESH_INACTIVE_EVERY == 0
+
+
+async def _sleep_unless(stop, delay: float):
+    """
+    Спит delay секунд; если выставлен stop — просыпается сразу.
+    """
+    if stop is None:
+        await asyncio.sleep(delay)
+        return
+    try:
+        await asyncio.wait_for(stop.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def refresh_due_schedules(now: float = None, shard: int = 0, shards: int = 1,
+                                **kwargs) -> RefreshStats:
+    """
+    Один тик планировщика: обновляет пользователей текущей корзины
+    (только своего шарда, если процессов несколько), которым пора
+    (см. is_due) и у которых не действует отсрочка.
+    Старты равномерно разносятся по REFRESH_SPREAD тика.
+    """
+    now = now or time.time()
+    bucket, cycle = current_bucket(now)
+    users = await run_db(list_due_users, bucket, REFRESH_BUCKETS, now, shard, shards)
+    users = [u for u in users if is_due(u[0], u[2], cycle, now)]
+    logger.info("Тик планировщика: шард %s/%s, корзина %s/%s, к обновлению %s пользователей.",
+                shard, shards, bucket, REFRESH_BUCKETS, len(users))
+    return await refresh_schedules(users, spread=REFRESH_TICK * REFRESH_SPREAD, **kwargs)
+
+
+async def refresh_all_schedules(**kwargs) -> RefreshStats:
+    """
+    Полный проход по всем пользователям без отсрочки (вне планировщика).
+    """
+    users = await run_db(list_due_users, 0, 1)
+    return await refresh_schedules(users, **kwargs)
+
+
+async def refresh_schedules(
+    users,
+    concurrency: int = REFRESH_CONCURRENCY,
+    timeout: float = REFRESH_USER_TIMEOUT,
+    rate: float = MESH_RATE_LIMIT,
+    write_batch: int = REFRESH_WRITE_BATCH,
+    spread: float = 0,
+    stop: asyncio.Event = None,
+    offload: bool = REFRESH_POOL_SIZE > 0,
+) -> RefreshStats:
+    """
+    Обновляет расписания пользователей users одним asyncio-конвейером.
+    users — [(telegram_user_id, encrypted_token, last_active_at, failures), ...]
+    в порядке приоритета (см. list_due_users).
+    Для каждого пользователя запрашиваются только дни, которые по plan_fetch
+    пора перезагрузить, а в БД пишутся только дни с изменившимся содержимым.
+    Ограничения:
+      - не больше `concurrency` пользователей одновременно,
+      - не дольше `timeout` секунд на пользователя,
+      - не больше `rate` запросов в секунду к МЭШ суммарно,
+      - запись в БД пачками по `write_batch` пользователей на транзакцию,
+      - старты разнесены по `spread` секунд в порядке приоритета.
+    С `offload` расшифровка токенов и разбор ответов МЭШ в строки schedule
+    идут пачками в пуле процессов (см. bot/offload.py), а не в потоке loop.
+    Если выставлен `stop`, ещё не начатые пользователи пропускаются,
+    а уже загруженное записывается в БД.
+    Отвергнутым МЭШ токенам назначается экспоненциальная отсрочка.
+    По окончании пишет в лог пропускную способность и p50/p95.
+    """
+    users = [u for u in users if u[1]]
+    begin_date, end_date = refresh_window()
+    fetch_times = await run_db(load_fetch_times, [u[0] for u in users], begin_date, end_date)
+    purge_before = purge_date()
+
+    limiter = RateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    sweep_offload = SweepOffload() if offload else None
+    stats = RefreshStats()
+    coalesced_before = mesh.coalesced_requests
+    pending = []
+    backoff = []
+
+    async def flush():
+        batch = pending[:]
+        pending.clear()
+        if not batch:
+            return
+        try:
+            stats.changed_days += await run_db(store_user_schedules, batch)
+            stats.commits += 1
+        except Exception as e:
+            logger.warning("Ошибка записи пачки из %s расписаний: %s", len(batch), e)
+            stats.write_failed += len(batch)
+
+    async def worker(i, tg_id, enc_token, failures):
+        plan = plan_fetch(fetch_times.get(tg_id, {}), begin_date, end_date)
+        if plan is None:
+            stats.fresh += 1
+            return
+        if spread:
+            await _sleep_unless(stop, (i + random.random()) * spread / len(users))
+        async with semaphore:
+            if stop is not None and stop.is_set():
+                return
+            if mesh.breaker.is_open():
+                # МЭШ недоступен — не тратим время, пользователь обновится в следующий раз
+                stats.unavailable += 1
+                return
+            stats.worker_started()
+            started = time.monotonic()
+            status, user_rows = await refresh_user(
+                tg_id, enc_token, limiter, timeout, *plan, sweep_offload
+            )
+            if status == 'unavailable':
+                stats.unavailable += 1
+                return
+            stats.add(status, time.monotonic() - started)
+        if status == 'auth':
+            backoff.append((tg_id, failures + 1, time.time() + backoff_delay(failures + 1)))
+        elif status in ('ok', 'skipped') and failures:
+            backoff.append((tg_id, 0, None))
+        if status == 'ok':
+            pending.append((tg_id, user_rows, *plan, purge_before, False))
+            if len(pending) >= write_batch:
+                await flush()
+
+    logger.info(
+        "Начинаем обновление расписаний: %s пользователей (concurrency=%s, timeout=%ss, rate=%s/s)",
+        len(users), concurrency, timeout, rate
+    )
+    await asyncio.gather(*(
+        worker(i, tg_id, enc_token, failures)
+        for i, (tg_id, enc_token, _, failures) in enumerate(users)
+    ))
+    await flush()
+    if backoff:
+        try:
+            await run_db(save_refresh_results, backoff)
+        except Exception as e:
+            logger.warning("Ошибка записи отсрочек обновления (%s пользователей): %s", len(backoff), e)
+    stats.finished = time.monotonic()
+
+    logger.info("Обновление расписаний завершено: %s", stats.summary())
+    logger.info("Кэш токенов: %s; совмещённых запросов к МЭШ за проход: %s",
+                token_cache.stats(), mesh.coalesced_requests - coalesced_before)
+    if sweep_offload is not None:
+        logger.info("Пул обработки: %s", sweep_offload.stats())
+    return stats
+
+
+async def refresh_job(context):
+    """
+    Колбэк JobQueue: запускает тик планировщика задачей в loop бота.
+    Если предыдущий проход ещё идёт, тик пропускается (проходы не перекрываются).
+    Колбэк сразу возвращается, чтобы остановка JobQueue не ждала весь проход:
+    его останавливает stop_refresh.
+    context.job.data может задать шард: {'shard': k, 'shards': n}.
+    """
+    global _refresh_task
+    if _stopping.is_set():
+        return
+    if _refresh_task is not None and not _refresh_task.done():
+        logger.warning("Предыдущий проход обновления ещё идёт, тик пропущен.")
+        return
+    _refresh_task = asyncio.create_task(_run_refresh_tick(**(context.job.data or {})))
+
+
+async def _run_refresh_tick(shard: int = 0, shards: int = 1):
+    try:
+        # лимиты делятся между шардами, чтобы вместе процессы не превышали общие
+        await refresh_due_schedules(
+            shard=shard, shards=shards, stop=_stopping,
+            concurrency=max(1, REFRESH_CONCURRENCY // shards),
+            rate=MESH_RATE_LIMIT / shards,
+        )
+    except Exception:
+        logger.exception("Ошибка в тике планировщика обновления.")
+
+
+async def stop_refresh(*args):
+    """
+    Останавливает фоновое обновление: новые тики не запускаются,
+    текущий проход дописывает загруженное и завершается. Если он не уложился
+    в REFRESH_STOP_TIMEOUT секунд, задача отменяется.
+    Подходит как post_stop-хук Application (аргумент application игнорируется).
+    """
+    _stopping.set()
+    task = _refresh_task
+    if task is None or task.done():
+        return
+    try:
+        await asyncio.wait_for(asyncio.shield(task), REFRESH_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Проход обновления не завершился за %ss, отменяем.", REFRESH_STOP_TIMEOUT)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
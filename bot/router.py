@@ -0,0 +1,119 @@
+# bot/router.py
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RouteStats:
+    """
+    Время обработки одного маршрута: число вызовов, ошибок, суммарное и максимальное время.
+    """
+
+    __slots__ = ('count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float, ok: bool):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов callback_data.
+    Маршрут — точное значение ('back_to_schedule') или префикс с типизированными
+    параметрами через '_' ('cal21_day_' + int -> handler(update, context, 5)).
+    Поиск — обращение к словарю (для префиксов — по одному на каждое возможное
+    число параметров), а не перебор регулярных выражений, так что новые
+    маршруты не замедляют разбор. Для каждого маршрута копится время обработки.
+    """
+
+    def __init__(self, fallback=None):
+        self._exact = {}
+        self._prefixes = {}  # {префикс: (handler, (тип, ...))}
+        self._param_counts = set()
+        self._stats = {}
+        self.fallback = fallback
+
+    def add(self, key: str, handler, *param_types):
+        """
+        Регистрирует маршрут. Без param_types key — точное значение callback_data,
+        иначе префикс (должен заканчиваться на '_'), за которым идут
+        len(param_types) параметров через '_', приводимых к этим типам.
+        """
+        if param_types:
+            if not key.endswith('_'):
+                raise ValueError(f"Префикс маршрута должен заканчиваться на '_': {key!r}")
+            self._prefixes[key] = (handler, param_types)
+            self._param_counts.add(len(param_types))
+        else:
+            self._exact[key] = (handler, ())
+        self._stats.setdefault(key, RouteStats())
+
+    def resolve(self, data: str):
+        """
+        Возвращает (key, handler, params) для callback_data или None.
+        """
+        if data in self._exact:
+            handler, _ = self._exact[data]
+            return data, handler, ()
+        for n in self._param_counts:
+            parts = data.rsplit('_', n)
+            if len(parts) != n + 1:
+                continue
+            key = parts[0] + '_'
+            route = self._prefixes.get(key)
+            if route is None or len(route[1]) != n:
+                continue
+            handler, param_types = route
+            try:
+                params = tuple(t(v) for t, v in zip(param_types, parts[1:]))
+            except ValueError:
+                continue
+            return key, handler, params
+        return None
+
+    async def dispatch(self, update, context):
+        """
+        Колбэк для CallbackQueryHandler: находит маршрут и вызывает его обработчик.
+        """
+        data = update.callback_query.data or ''
+        resolved = self.resolve(data)
+        if resolved is None:
+            if self.fallback is not None:
+                await self.fallback(update, context)
+            return
+
+        key, handler, params = resolved
+        started = time.perf_counter()
+        ok = False
+        try:
+            await handler(update, context, *params)
+            ok = True
+        finally:
+            elapsed = time.perf_counter() - started
+            self._stats[key].add(elapsed, ok)
+            logger.debug("callback %s%s: %.1f ms", key, params or '', elapsed * 1000)
+
+    def stats(self) -> dict:
+        """
+        {маршрут: {'count', 'errors', 'avg', 'max'}} — время в секундах.
+        """
+        return {key: s.as_dict() for key, s in self._stats.items() if s.count}
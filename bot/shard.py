@@ -0,0 +1,233 @@
+# bot/shard.py
+
+import asyncio
+import hmac
+import logging
+import signal
+
+import aiohttp
+from aiohttp import web
+from telegram import Bot, Update
+
+from config import settings
+from .webhook import (
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    SECRET_HEADER,
+    HEALTH_PORT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Рабочий процесс k принимает апдейты на 127.0.0.1:WORKER_BASE_PORT+k,
+# его /health — на HEALTH_PORT+1+k
+WORKER_BASE_PORT = getattr(settings, 'WORKER_BASE_PORT', 8100)
+# Сколько раз фронт пытается передать апдейт рабочему процессу
+FORWARD_ATTEMPTS = getattr(settings, 'FORWARD_ATTEMPTS', 5)
+# Long polling во фронте: таймаут getUpdates (секунды)
+POLL_TIMEOUT = getattr(settings, 'POLL_TIMEOUT', 30)
+# Сколько секунд фронт ждёт готовности рабочих процессов при запуске
+WORKER_START_TIMEOUT = getattr(settings, 'WORKER_START_TIMEOUT', 60)
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+def worker_port(shard: int) -> int:
+    return WORKER_BASE_PORT + shard
+
+
+def worker_health_port(shard: int) -> int:
+    return HEALTH_PORT + 1 + shard
+
+
+def update_user_id(data: dict):
+    """
+    telegram_user_id отправителя апдейта (сырой JSON Bot API) или, если его нет, id чата.
+    Разбирает только словарь — без построения объектов Update.
+    """
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user')
+        if sender and 'id' in sender:
+            return sender['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return chat['id']
+    return None
+
+
+class UpdateRouter:
+    """
+    Передаёт апдейты рабочим процессам по telegram_user_id % shards.
+    Апдейты одного шарда уходят строго по очереди (порядок сообщений
+    пользователя сохраняется), разные шарды — параллельно.
+    """
+
+    def __init__(self, shards: int):
+        self.shards = shards
+        self.forwarded = [0] * shards
+        self.dropped = 0
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        return self._session
+
+    async def route(self, data: dict):
+        user_id = update_user_id(data)
+        shard = shard_of(user_id or 0, self.shards)
+        async with self._locks[shard]:
+            await self._forward(shard, data)
+
+    async def _forward(self, shard: int, data: dict):
+        url = f"http://127.0.0.1:{worker_port(shard)}{WEBHOOK_PATH}"
+        headers = {SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+        for attempt in range(FORWARD_ATTEMPTS):
+            try:
+                async with self._get_session().post(url, json=data, headers=headers) as response:
+                    if response.status == 200:
+                        self.forwarded[shard] += 1
+                        return
+                    if response.status < 500:
+                        logger.error("Рабочий %s отверг апдейт %s: HTTP %s",
+                                     shard, data.get('update_id'), response.status)
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Рабочий %s недоступен (%s), попытка %s.", shard, e, attempt + 1)
+            await asyncio.sleep(min(2 ** attempt * 0.1, 2))
+        self.dropped += 1
+        logger.error("Апдейт %s не доставлен рабочему %s.", data.get('update_id'), shard)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+async def wait_for_workers(shards: int, stop: asyncio.Event, timeout: float = WORKER_START_TIMEOUT):
+    """
+    Ждёт, пока /health всех рабочих процессов ответит 200
+    (не дольше timeout секунд), чтобы первые апдейты не терялись.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+        for shard in range(shards):
+            url = f"http://127.0.0.1:{worker_health_port(shard)}/health"
+            while not stop.is_set():
+                try:
+                    async with session.get(url) as response:
+                        if response.status == 200:
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+                if loop.time() > deadline:
+                    logger.warning("Рабочий %s не ответил за %ss, продолжаем без ожидания.", shard, timeout)
+                    break
+                await asyncio.sleep(0.5)
+
+
+async def _poll(bot: Bot, router: UpdateRouter, stop: asyncio.Event):
+    """
+    getUpdates в цикле; offset сдвигается только после того,
+    как вся пачка передана рабочим процессам.
+    """
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES,
+                read_timeout=POLL_TIMEOUT + 10,
+            )
+        except Exception as e:
+            logger.warning("Ошибка getUpdates: %s", e)
+            await asyncio.sleep(1)
+            continue
+        if updates:
+            await asyncio.gather(*(router.route(u.to_dict()) for u in updates))
+            offset = updates[-1].update_id + 1
+
+
+def check_front(mode: str):
+    """
+    Проверяет настройки фронта — до запуска рабочих процессов и сервера.
+    """
+    if mode == 'webhook' and not WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook нужен settings.WEBHOOK_URL")
+
+
+async def run_front(token: str, shards: int, mode: str = 'polling', base_url: str = None):
+    """
+    Фронтовой процесс: получает апдейты Telegram (long polling или вебхук)
+    и раздаёт их рабочим процессам (см. UpdateRouter). Сам апдейты не обрабатывает.
+    Работает до SIGINT/SIGTERM.
+    """
+    check_front(mode)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    router = UpdateRouter(shards)
+    bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+    runner = None
+    await wait_for_workers(shards, stop)
+    async with bot:
+        try:
+            if mode == 'webhook':
+                pending = set()
+
+                async def handle_update(request: web.Request):
+                    if WEBHOOK_SECRET and not hmac.compare_digest(
+                        request.headers.get(SECRET_HEADER, ''), WEBHOOK_SECRET
+                    ):
+                        return web.Response(status=403)
+                    try:
+                        data = await request.json()
+                    except ValueError:
+                        return web.Response(status=400)
+                    # Отвечаем Telegram сразу; порядок внутри шарда держит UpdateRouter
+                    task = asyncio.create_task(router.route(data))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    return web.Response()
+
+                app = web.Application()
+                app.router.add_post(WEBHOOK_PATH, handle_update)
+                runner = web.AppRunner(app, access_log=None)
+                await runner.setup()
+                await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True,
+                )
+                logger.info("Фронт: вебхук %s:%s%s -> %s рабочих", WEBHOOK_LISTEN, WEBHOOK_PORT,
+                            WEBHOOK_PATH, shards)
+                await stop.wait()
+                await runner.cleanup()
+                runner = None
+                await asyncio.gather(*pending, return_exceptions=True)
+            else:
+                logger.info("Фронт: long polling -> %s рабочих", shards)
+                poller = asyncio.create_task(_poll(bot, router, stop))
+                await stop.wait()
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+            await router.close()
+            logger.info("Фронт остановлен: передано %s, потеряно %s.", router.forwarded, router.dropped)
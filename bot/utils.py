@@ -7,9 +7,29 @@ WEEKDAYS_RU = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
 MONTHS_RU    = ["янв", "фев", "мар", "апр", "май", "июн",
                 "июл", "авг", "сен", "окт", "ноя", "дек"]
 
+# Календарь одинаков для всех пользователей и меняется только в полночь:
+# на текущую дату (_calendar_date) храним 21 день и готовые клавиатуры
+# для каждого offset 0..20.
+_calendar_date = None
+_days_21 = ()
+_keyboards = {}
+
+def _refresh_calendar():
+    """
+    Пересчитывает 21 день и все клавиатуры, если наступили новые (местные) сутки.
+    """
+    global _calendar_date, _days_21, _keyboards
+    today = date.today()
+    if today == _calendar_date:
+        return
+    days_21 = _build_21days(today)
+    _keyboards = {offset: _build_calendar_keyboard(days_21, offset) for offset in range(21)}
+    _days_21 = days_21
+    _calendar_date = today
+
 def compute_21days():
     """
-    Возвращает список из 21 date:
+    Возвращает кортеж из 21 date (один и тот же объект до полуночи):
       - прошлая неделя (7 дней),
       - текущая неделя (7 дней),
       - следующая неделя (7 дней).
@@ -19,14 +39,16 @@ def compute_21days():
                7..13 => текущая
                14..20=> следующая
     """
-    today = date.today()
+    _refresh_calendar()
+    return _days_21
+
+def _build_21days(today: date):
     # Понедельник текущей недели
     current_monday = today - timedelta(days=today.weekday())
     # Понедельник предыдущей недели
     start_date = current_monday - timedelta(days=7)
 
-    days_21 = [start_date + timedelta(days=i) for i in range(21)]
-    return days_21
+    return tuple(start_date + timedelta(days=i) for i in range(21))
 
 def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
     """
@@ -45,16 +67,20 @@ def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
       "cal21_day_X"     -> пользователь выбрал день (X=0..20)
       "cal21_prev_OFF"  -> смещение offset -= 5
       "cal21_next_OFF"  -> смещение offset += 5
-    """
-
-    days_21 = compute_21days()
 
+    Клавиатуры строятся один раз в сутки (см. _refresh_calendar),
+    здесь — только выбор готовой по offset.
+    """
     # Гарантируем, что offset не вышел за границы (0..20)
     if offset < 0:
         offset = 0
     if offset >= 21:
         offset = 0
 
+    _refresh_calendar()
+    return _keyboards[offset]
+
+def _build_calendar_keyboard(days_21, offset: int) -> InlineKeyboardMarkup:
     # Покажем 5 дат начиная с offset
     slice_end = min(offset + 5, 21)  # не больше 21
     slice_days = days_21[offset:slice_end]
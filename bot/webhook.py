@@ -0,0 +1,138 @@
+# bot/webhook.py
+
+import asyncio
+import hmac
+import logging
+import signal
+import time
+
+from aiohttp import web
+from telegram import Update
+
+from config import settings
+from .handlers import callback_router
+from .mesh import breaker
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram шлёт апдейты (https://host[:port]),
+# и путь обработчика на нашем сервере
+WEBHOOK_URL = getattr(settings, 'WEBHOOK_URL', None)
+WEBHOOK_PATH = getattr(settings, 'WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = getattr(settings, 'WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = getattr(settings, 'WEBHOOK_PORT', 8080)
+# Секрет, который Telegram передаёт в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = getattr(settings, 'WEBHOOK_SECRET', None)
+# Эндпоинт /health — только на локальном интерфейсе
+HEALTH_LISTEN = getattr(settings, 'HEALTH_LISTEN', '127.0.0.1')
+HEALTH_PORT = getattr(settings, 'HEALTH_PORT', 8081)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def make_webhook_app(application) -> web.Application:
+    """
+    aiohttp-приложение, принимающее апдейты Telegram: проверяет секрет,
+    кладёт Update в application.update_queue и сразу отвечает 200.
+    Обработку (параллельно, до concurrent_updates штук) ведёт Application.
+    """
+    async def handle_update(request: web.Request):
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ''), WEBHOOK_SECRET
+        ):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.warning("Некорректный апдейт от вебхука: %s", e)
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    return app
+
+
+def make_health_app(application, started: float) -> web.Application:
+    """
+    aiohttp-приложение с GET /health: 200, пока Application работает, иначе 503.
+    В ответе — и время обработки нажатий кнопок по маршрутам (callback_router.stats()).
+    """
+    async def health(request: web.Request):
+        return web.json_response(
+            {
+                'status': 'ok' if application.running else 'stopping',
+                'uptime': round(time.monotonic() - started, 1),
+                'update_queue': application.update_queue.qsize(),
+                'concurrent_updates': application.concurrent_updates,
+                'mesh': breaker.state,
+                'callbacks': callback_router.stats(),
+            },
+            status=200 if application.running else 503,
+        )
+
+    app = web.Application()
+    app.router.add_get('/health', health)
+    return app
+
+
+async def _start_site(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def run_webhook(application, drop_pending_updates: bool = True,
+                      listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                      health_port: int = HEALTH_PORT, register: bool = True):
+    """
+    Запускает бота в режиме вебхука (вместо run_polling) на текущем event loop:
+    initialize/post_init -> HTTP-серверы -> set_webhook -> start, затем ждёт
+    SIGINT/SIGTERM и останавливается в обратном порядке
+    (stop/post_stop -> shutdown/post_shutdown), как run_polling.
+    register=False — вебхук в Telegram не регистрируется: апдейты присылает
+    фронтовой процесс (см. bot/shard.py).
+    """
+    if register and not WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook нужен settings.WEBHOOK_URL")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    started = time.monotonic()
+    runners = []
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        runners.append(await _start_site(make_webhook_app(application), listen, port))
+        runners.append(await _start_site(make_health_app(application, started), HEALTH_LISTEN, health_port))
+        if register:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=drop_pending_updates,
+            )
+        await application.start()
+        logger.info("Вебхук слушает %s:%s%s, health — http://%s:%s/health (concurrent_updates=%s)",
+                    listen, port, WEBHOOK_PATH, HEALTH_LISTEN, health_port,
+                    application.concurrent_updates)
+        await stop.wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,11 @@
+# config/settings.example.py
+# Скопируйте в config/settings.py и заполните. Остальные параметры
+# (BOT_MODE, SHARDS, REFRESH_*, MESH_* и т.д.) необязательны: значения
+# по умолчанию и описание — рядом с их чтением в bot/ и main.py.
+
+# Токен бота от @BotFather
+TELEGRAM_TOKEN = ""
+# Файл SQLite с токенами, расписанием и состоянием бота
+DATABASE_PATH = "bot.db"
+# Ключ шифрования токенов МЭШ (см. config/generate_key.py)
+ENCRYPTION_KEY_PATH = "encryption.key"
@@ -1,119 +1,150 @@
-# main.py (СИНХРОННЫЙ вариант с run_polling)
+# main.py (run_polling или вебхук — см. BOT_MODE)
 
+import asyncio
 import logging
-from datetime import date, timedelta
-from telegram.ext import ApplicationBuilder
+import signal
+from telegram.ext import ApplicationBuilder, ContextTypes
 from bot.handlers import setup_handlers
-from bot.database import init_db, init_schedule_db
+from bot.mesh import close_http_session, set_shards
+from bot.offload import shutdown_pool
+from bot.refresher import REFRESH_TICK, refresh_job, stop_refresh
+from bot.persistence import SQLitePersistence, UserData
+from bot.webhook import run_webhook
+from bot.shard import check_front, run_front, worker_port, worker_health_port
+from bot.database import (
+    init_db,
+    init_schedule_db,
+    init_media_db,
+    init_persistence_db,
+    close_db_connections,
+)
 from config import settings
-# APScheduler (не async, а background)
-from apscheduler.schedulers.background import BackgroundScheduler
 
 
-def main():
-    logging.basicConfig(level=logging.DEBUG)
-    logger = logging.getLogger(__name__)
+# Режим получения апдейтов: 'polling' (по умолчанию) или 'webhook' (см. bot/webhook.py)
+BOT_MODE = getattr(settings, 'BOT_MODE', 'polling')
+# Сколько апдейтов обрабатывается параллельно (1 — строго по очереди)
+CONCURRENT_UPDATES = getattr(settings, 'CONCURRENT_UPDATES', 16)
+# Адрес Bot API вместо https://api.telegram.org/bot (например, локальный тестовый сервер)
+TELEGRAM_API_URL = getattr(settings, 'TELEGRAM_API_URL', None)
+# Число рабочих процессов. Больше 1 — фронтовой процесс получает апдейты
+# (способом BOT_MODE) и раздаёт их по telegram_user_id % SHARDS (см. bot/shard.py)
+SHARDS = getattr(settings, 'SHARDS', 1)
 
-    init_db()
-    init_schedule_db()
 
-    application = ApplicationBuilder().token(f"{settings.TELEGRAM_TOKEN}").build()
+async def on_shutdown(application):
+    await close_http_session()  # общий HTTP-пул к МЭШ
+    shutdown_pool()  # пул процессов фонового обновления (если запускался)
 
-    setup_handlers(application)
 
-    # Сбрасываем вебхук
-    application.bot.delete_webhook(drop_pending_updates=True)
+def build_application(shard: int = 0, shards: int = 1):
+    """
+    Собирает Application с хендлерами и фоновым обновлением — общее для всех режимов.
+    shard/shards — какую часть пользователей обслуживает процесс
+    (и какую долю общих лимитов запросов к МЭШ он получает).
+    """
+    set_shards(shards)
+    builder = (
+        ApplicationBuilder()
+        .token(f"{settings.TELEGRAM_TOKEN}")
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .context_types(ContextTypes(user_data=UserData))
+        .persistence(SQLitePersistence(shard=shard, shards=shards))  # user_data и состояние /login в SQLite
+        .post_stop(stop_refresh)  # останавливаем текущий проход обновления
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
 
-    # Создаём BackgroundScheduler (не async)
-    sched = BackgroundScheduler()
-    from datetime import datetime
+    setup_handlers(application)
 
-    sched.add_job(
-        update_all_schedules,
-        'interval',
-        seconds=3600,
-        next_run_time=datetime.now()  # Выполнить прямо сейчас
+    # Фоновое обновление расписаний — задача JobQueue в том же event loop,
+    # что и хендлеры (общие HTTP-пул, кэши и пул БД).
+    # Каждый тик обновляется одна корзина пользователей,
+    # за час (REFRESH_INTERVAL) обходятся все
+    application.job_queue.run_repeating(
+        refresh_job,
+        interval=REFRESH_TICK,
+        first=0,  # Выполнить прямо сейчас
+        name='refresh_schedules',
+        data={'shard': shard, 'shards': shards},
     )
+    return application
 
-    sched.start()
 
-    logger.info("Запускаем run_polling() ...")
-    application.run_polling()  # <-- СИНХРОННЫЙ вызов
-    # Когда run_polling() завершится (например, Ctrl+C), идёт выход из main().
-
-    logger.info("Stopping APScheduler...")
-    sched.shutdown()
-def update_all_schedules():
+def run_worker(shard: int, shards: int):
+    """
+    Рабочий процесс: обслуживает пользователей telegram_user_id % shards == shard
+    (апдейты от фронта на локальном порту и фоновое обновление их расписаний).
+    """
+    logging.basicConfig(level=logging.INFO, format=f"[worker {shard}] %(name)s %(levelname)s %(message)s")
+    application = build_application(shard, shards)
+    try:
+        asyncio.run(run_webhook(
+            application, listen='127.0.0.1', port=worker_port(shard),
+            health_port=worker_health_port(shard), register=False,
+        ))
+    finally:
+        close_db_connections()
+
+
+def run_sharded(logger):
     """
-    Функция, которую APScheduler будет вызывать раз в час.
-    Внимание: теперь она обычная (sync) или внутри можно вызывать .run_until_complete(async...) при необходимости.
+    Запускает SHARDS рабочих процессов и фронт в текущем процессе.
+    По SIGINT/SIGTERM фронт останавливается, рабочие завершаются штатно.
     """
-    import asyncio
-    import logging
+    import multiprocessing
+
+    check_front(BOT_MODE)
+    # spawn: дочерние процессы не наследуют соединения SQLite и event loop родителя
+    ctx = multiprocessing.get_context('spawn')
+    workers = [
+        ctx.Process(target=run_worker, args=(shard, SHARDS), name=f"worker-{shard}")
+        for shard in range(SHARDS)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(run_front(settings.TELEGRAM_TOKEN, SHARDS, BOT_MODE, TELEGRAM_API_URL))
+    finally:
+        # Повторный Ctrl+C не должен оставить рабочих без присмотра
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()  # SIGTERM — рабочий останавливается штатно
+        for worker in workers:
+            worker.join(timeout=60)
+        logger.info("Рабочие процессы остановлены.")
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
-    from bot.database import get_db_connection, clear_user_schedule, save_events_in_db
-    from bot.auth import decrypt_token
-    from octodiary.apis import AsyncMobileAPI
-    from octodiary.urls import Systems
-
-    logger.info("Начинаем обновление расписаний (BackgroundScheduler)...")
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_user_id, encrypted_token FROM users")
-    rows = cur.fetchall()
-    conn.close()
-
-    # Поскольку внутри хотим вызвать async методы, делаем маленький вспомогательный "event_loop"
-    loop = asyncio.new_event_loop()
-
-    for (tg_id, enc_token) in rows:
-        if not enc_token:
-            continue
-        try:
-            token_data = decrypt_token(enc_token)
-            mesh_api = AsyncMobileAPI(system=Systems.MES)
-            mesh_api.token = token_data
-
-            async def fetch_events():
-                profiles = await mesh_api.get_users_profile_info()
-                if not profiles:
-                    logger.warning(f"Нет профилей у {tg_id}. Пропускаем.")
-                    return None
-
-                first_profile = profiles[0]
-                fam = await mesh_api.get_family_profile(profile_id=first_profile.id)
-                if not fam.children:
-                    logger.warning(f"У пользователя {tg_id} нет children. Пропускаем.")
-                    return None
-
-                child = fam.children[0]
-                person_guid = child.contingent_guid
-                mes_role = fam.profile.type
-
-                begin_date = date.today() - timedelta(days=10)
-                end_date = date.today() + timedelta(days=10)
-
-                events = await mesh_api.get_events(
-                    person_id=person_guid,
-                    mes_role=mes_role,
-                    begin_date=begin_date,
-                    end_date=end_date
-                )
-                return events
-
-            # вызываем корутину fetch_events() в нашем временном event loop
-            events = loop.run_until_complete(fetch_events())
-            if events:
-                clear_user_schedule(tg_id)
-                save_events_in_db(tg_id, events)
-                logger.info(f"Успешно обновили расписание user_id={tg_id}.")
-        except Exception as e:
-            logger.warning(f"Ошибка при обновлении расписания user_id={tg_id}: {e}")
-
-    loop.close()
-    logger.info("Глобальное обновление расписаний завершено.")
+    init_db()
+    init_schedule_db()
+    init_media_db()
+    init_persistence_db()
+
+    if SHARDS > 1:
+        close_db_connections()
+        logger.info("Запускаем %s рабочих процессов ...", SHARDS)
+        run_sharded(logger)
+        return
+
+    application = build_application()
+
+    if BOT_MODE == 'webhook':
+        logger.info("Запускаем вебхук ...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Запускаем run_polling() ...")
+        # drop_pending_updates: вебхук сбрасывается, накопившиеся апдейты отбрасываются
+        application.run_polling(drop_pending_updates=True)  # <-- СИНХРОННЫЙ вызов
+    # Когда бот остановлен (например, Ctrl+C), идёт выход из main().
+
+    close_db_connections()
 
 if __name__ == "__main__":
     main()